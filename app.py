@@ -1,72 +1,546 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.middleware.proxy_fix import ProxyFix
+import contextlib
+import copy
+import functools
+import io
 import os
-import tempfile
+import queue
 import re
-import subprocess
-import json
 import shutil
-
-# Simple cache for tool checks
-_tool_cache = {}
+import subprocess
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import quote
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from yt_dlp import YoutubeDL
+from yt_dlp.networking.exceptions import HTTPError, TransportError
+from yt_dlp.utils import DownloadError, GeoRestrictedError
 
 # Known ffmpeg path for Windows WinGet installation
 FFMPEG_WINGET_PATH = r"C:\Users\BAPS\AppData\Local\Microsoft\WinGet\Packages\Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe\ffmpeg-8.0.1-full_build\bin\ffmpeg.exe"
 
 
-def tool_exists(cmd):
-    """Return True if command exists on PATH (cached)."""
-    if cmd in _tool_cache:
-        return _tool_cache[cmd]
-    
-    # Special handling for ffmpeg on Windows
-    if cmd == 'ffmpeg' and os.name == 'nt':
-        # Try known WinGet installation path first
-        if os.path.exists(FFMPEG_WINGET_PATH):
-            try:
-                subprocess.run([FFMPEG_WINGET_PATH, '--version'], capture_output=True, text=True, timeout=5)
-                _tool_cache[cmd] = FFMPEG_WINGET_PATH
-                return FFMPEG_WINGET_PATH
-            except Exception:
-                pass
+# Deletion table for characters that are invalid in filenames (str.translate runs in C)
+INVALID_FILENAME_CHARS = str.maketrans('', '', '<>:"/\\|?*')
+# Same characters as a set, to skip the translate for the (usual) titles that contain none
+INVALID_FILENAME_CHAR_SET = frozenset('<>:"/\\|?*')
+
+# Browser-like headers sent with every yt-dlp request (helps avoid bot detection on Render)
+YTDLP_HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+# Number of DASH/HLS fragments yt-dlp downloads in parallel within one job
+YTDLP_CONCURRENT_FRAGMENTS = 8
+
+# aria2c connection settings used for merged (video+audio) downloads when aria2c is installed
+ARIA2C_ARGS = ['-x16', '-s16', '-k1M']
+
+# Staged yt-dlp downloads are abandoned after this long, so a stalled download can't hold a
+# worker thread and a YouTube slot indefinitely (gthread workers never kill stuck threads)
+DOWNLOAD_TIMEOUT = int(os.environ.get('DOWNLOAD_TIMEOUT', 300))  # seconds
+DOWNLOAD_TIMEOUT_ERROR = 'Download timed out. The video may be too large or your connection is slow.'
+
+# Smallest tmpfs worth staging downloads in (see _download_tmp_root)
+MIN_TMPFS_SIZE = 1024 * 1024 * 1024
+
+# Per-thread YoutubeDL instances, see get_ydl()
+_ydl_local = threading.local()
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a per-entry TTL"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value, or None if it is missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        """Store a value for ttl seconds, evicting the least recently used entries"""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+# Short-lived LRU cache of extracted video info, keyed by video ID, so the
+# /api/download call that follows /api/qualities doesn't re-run the extraction
+VIDEO_INFO_CACHE_TTL = 300  # seconds
+VIDEO_INFO_CACHE_MAXSIZE = 512
+# Failed extractions (unavailable, private, ...) are remembered briefly so repeated
+# clicks on a dead link don't each cost a round trip to YouTube
+VIDEO_INFO_ERROR_TTL = 30  # seconds
+# Errors worth retrying straight away are never cached
+TRANSIENT_ERROR_MARKERS = ('timed out', 'timeout', 'network')
+_video_info_cache = TTLCache(VIDEO_INFO_CACHE_MAXSIZE)
+# Bulky parts of yt-dlp's info dict that neither the qualities list nor the downloads use.
+# Dropping them before caching keeps cached entries (and the per-download deepcopy) small.
+UNUSED_INFO_KEYS = ('subtitles', 'automatic_captions', 'thumbnails', 'heatmap', 'chapters', 'description', 'tags', 'categories')
+# Serialized /api/qualities responses (body bytes and ETag) per video ID, so repeat
+# queries skip the format processing and JSON encoding as well as the extraction
+_qualities_response_cache = TTLCache(VIDEO_INFO_CACHE_MAXSIZE)
+# Extractions in progress, keyed like the cache: concurrent misses for the same video
+# wait on the first caller's Future instead of each running yt-dlp
+_inflight_extractions = {}
+_inflight_extractions_lock = threading.Lock()
+
+# Protocols whose formats are fetched with plain ranged requests (see stream_format())
+DIRECT_PROTOCOLS = ('http', 'https')
+# Protocols ffmpeg reads itself, so such formats can be remuxed to the client on the fly
+FFMPEG_STREAM_PROTOCOLS = ('m3u8', 'm3u8_native')
+
+# Chunk size used when proxying a format's bytes to the client (larger chunks mean fewer
+# Python-level iterations per download)
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def _build_http_session():
+    """
+    Create the shared session used to proxy format bytes from YouTube's CDN
     
+    Pooled keep-alive connections let successive range requests (and the next
+    download from the same edge) skip the TCP and TLS handshakes. Transient
+    connection errors and 5xx/429 responses are retried with backoff.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=['GET', 'HEAD'],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+HTTP_SESSION = _build_http_session()
+# (connect, read) timeouts for proxied requests: a dead CDN edge fails fast and is retried,
+# while a slow but live transfer still gets the same read allowance as yt-dlp
+UPSTREAM_TIMEOUT = (3.05, 30)
+
+# Background download jobs (see /api/jobs): worker threads and how long finished jobs are kept
+DOWNLOAD_JOB_WORKERS = int(os.environ.get('DOWNLOAD_JOB_WORKERS', 4))
+DOWNLOAD_JOB_TTL = 3600  # seconds
+_download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_JOB_WORKERS, thread_name_prefix='download-job')
+# Job state is kept in a JSON file in the job's staging dir rather than in memory, so a status
+# poll or file fetch can be answered by any worker process, not just the one running the job
+JOB_STATE_FILE = 'job.json'
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+# Progress is written to the state file at most this often
+JOB_PROGRESS_SAVE_INTERVAL = 1.0  # seconds
+
+# At most this many extractions talk to YouTube at once per process; the rest wait,
+# instead of bursting into 429s that trigger even more retries.
+# The limit is per worker process: the whole server allows workers x YT_CONCURRENCY.
+YT_CONCURRENCY = int(os.environ.get('YT_CONCURRENCY', 8))
+_youtube_semaphore = threading.BoundedSemaphore(YT_CONCURRENCY)
+# Downloads (staged, proxied or remuxed) hold a connection to YouTube for minutes, so they
+# get their own per-process slots; a burst of downloads can't leave extractions waiting
+DOWNLOAD_CONCURRENCY = int(os.environ.get('DOWNLOAD_CONCURRENCY', 8))
+_download_semaphore = threading.BoundedSemaphore(DOWNLOAD_CONCURRENCY)
+# How long a request waits for a free slot before it is turned away with 503 + Retry-After
+YT_QUEUE_TIMEOUT = float(os.environ.get('YT_QUEUE_TIMEOUT', 20))
+BUSY_RETRY_AFTER = 10  # seconds
+# Requests waiting on another request's extraction of the same video give up after this long,
+# rather than holding a worker thread for as long as a stuck extraction takes
+EXTRACTION_WAIT_TIMEOUT = YT_QUEUE_TIMEOUT + 60
+
+
+class ServerBusyError(Exception):
+    """Raised when no YouTube slot frees up within YT_QUEUE_TIMEOUT"""
+
+
+@contextlib.contextmanager
+def youtube_slot(semaphore=_youtube_semaphore):
+    """Hold one of the YT_CONCURRENCY slots (or of another semaphore), or raise ServerBusyError if none frees up in time"""
+    if not semaphore.acquire(timeout=YT_QUEUE_TIMEOUT):
+        raise ServerBusyError('The server is busy right now. Please try again in a few seconds.')
     try:
-        # Try direct command
-        subprocess.run([cmd, '--version'], capture_output=True, text=True, timeout=5)
-        _tool_cache[cmd] = cmd
-        return cmd
-    except Exception:
-        pass
+        yield
+    finally:
+        semaphore.release()
+
+# Per-client token bucket for the endpoints that make YouTube requests, so one client
+# can't occupy every YouTube slot. Buckets are per worker process, like the slots.
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 10))
+RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE', 30))
+RATE_LIMITED_ENDPOINTS = frozenset({'get_qualities', 'download_video', 'create_download_job'})
+RATE_LIMIT_MAX_CLIENTS = 10000
+_rate_buckets = {}
+_rate_buckets_lock = threading.Lock()
+
+# /api/qualities/batch looks its URLs up on this pool; extractions still take YouTube slots.
+# A batch costs one rate-limit token per distinct URL, so it can't be larger than a full bucket.
+BATCH_MAX_URLS = min(20, RATE_LIMIT_BURST)
+_batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_URLS, thread_name_prefix='qualities-batch')
+
+# YouTube video/shorts/embed/live URLs accepted by the API; group 1 captures the 11-character video ID.
+# Playlist links are not accepted: yt-dlp would extract every entry while holding a YouTube slot.
+YOUTUBE_URL_RE = re.compile(
+    r'^https?://(?:www\.|m\.|music\.)?'
+    r'(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)([A-Za-z0-9_-]{11})(?![\w-])',
+    re.IGNORECASE
+)
+
+
+@functools.lru_cache(maxsize=16)
+def tool_exists(cmd):
+    """Return the path of a command found on PATH (cached), or None."""
+    # shutil.which only stats PATH entries (and honors PATHEXT on Windows) instead of spawning the tool
+    path = shutil.which(cmd)
     
-    # Try with .exe extension on Windows
-    if os.name == 'nt':
-        try:
-            subprocess.run([f'{cmd}.exe', '--version'], capture_output=True, text=True, timeout=5)
-            _tool_cache[cmd] = f'{cmd}.exe'
-            return f'{cmd}.exe'
-        except Exception:
-            pass
+    # Special handling for ffmpeg on Windows: fall back to the known WinGet installation path
+    if not path and cmd == 'ffmpeg' and os.name == 'nt' and os.path.exists(FFMPEG_WINGET_PATH):
+        path = FFMPEG_WINGET_PATH
     
-    _tool_cache[cmd] = None
-    return None
+    return path
+
+
+class TempDirFile(io.FileIO):
+    """Read-only file that queues its temporary directory for removal once closed"""
+
+    def __init__(self, path, temp_dir):
+        super().__init__(path, 'rb')
+        self.temp_dir = temp_dir
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            schedule_cleanup(self.temp_dir)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that parses request bodies and serializes responses with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of decoding to str for Flask to re-encode
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        body = orjson.dumps(obj, default=self.default, option=option)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
 
 app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+app.json = OrjsonProvider(app)
+# Compress JSON responses only; video bytes are already compressed and are streamed
+app.config['COMPRESS_MIMETYPES'] = ['application/json']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_BR_LEVEL'] = 5
+app.config['COMPRESS_MIN_SIZE'] = 500
+Compress(app)
+CORS(app, resources={r"/api/*": {"origins": "*", "expose_headers": ["ETag"]}})
+# Render terminates connections at its proxy; trust its X-Forwarded-For so remote_addr is the client
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get('PROXY_FIX_HOPS', 1)))
 
+@functools.lru_cache(maxsize=1024)
 def sanitize_filename(filename):
     """Sanitize filename to remove invalid characters"""
-    # Remove path separators and invalid characters
-    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
-    # Remove leading/trailing dots and spaces
-    filename = filename.strip('. ')
-    # Limit length
-    if len(filename) > 200:
-        filename = filename[:200]
-    return filename if filename else 'video'
+    # Drop path separators and invalid characters, trim dots/spaces, cap the length
+    if not INVALID_FILENAME_CHAR_SET.isdisjoint(filename):
+        filename = filename.translate(INVALID_FILENAME_CHARS)
+    return filename.strip('. ')[:200] or 'video'
+
+def find_node_runtime():
+    """Return the first working Node.js executable, or None."""
+    node_paths = ['node', '/usr/bin/node', '/usr/local/bin/node', '/opt/render/project/node_modules/.bin/node']
+    for node_path in node_paths:
+        resolved = shutil.which(node_path)
+        if resolved:
+            print(f"Found Node.js at: {resolved}")
+            return resolved
+    print("Node.js not found, using fallback extraction method")
+    return None
+
+
+def _detect_tools():
+    """Resolve external tool paths once at startup instead of probing per request"""
+    return tool_exists('ffmpeg'), find_node_runtime(), tool_exists('aria2c')
+
+
+FFMPEG_PATH, NODE_PATH, ARIA2C_PATH = _detect_tools()
+
+
+def _youtube_extractor_args():
+    """
+    Player clients used for YouTube extraction
+    
+    ios/mweb return formats without JS signature deciphering, so by default extraction
+    needs neither the JS player nor a JavaScript runtime. YouTube regularly breaks
+    individual clients; YTDLP_PLAYER_CLIENTS (e.g. "web,ios") swaps them without a
+    code change. Other clients may need the JS player, which is only fetched when
+    Node.js is available to run it; without it those clients' signed formats are missing.
+    """
+    clients = os.environ.get('YTDLP_PLAYER_CLIENTS')
+    if clients:
+        args = {'player_client': [client.strip() for client in clients.split(',') if client.strip()]}
+        if not NODE_PATH:
+            print("YTDLP_PLAYER_CLIENTS is set but Node.js was not found; skipping the JS player")
+            args['player_skip'] = ['js']
+        return args
+    return {'player_client': ['ios', 'mweb'], 'player_skip': ['js', 'configs']}
+
+
+def _build_info_opts():
+    """Build the yt-dlp options for metadata extraction (equivalent of the old `--dump-json` flags)"""
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        'socket_timeout': 30,
+        'http_headers': {
+            **YTDLP_HTTP_HEADERS,
+            'Sec-Fetch-Dest': 'document',
+            'Sec-Fetch-Mode': 'navigate',
+            'Sec-Fetch-Site': 'none',
+            'Cache-Control': 'max-age=0',
+        },
+        'extractor_args': {
+            'youtube': _youtube_extractor_args(),
+        },
+    }
+    
+    # yt-dlp defaults to deno; point it at the Node.js found at startup for clients that need the JS player
+    if NODE_PATH:
+        opts['js_runtimes'] = {'node': {'path': NODE_PATH}}
+    
+    return opts
+
+
+YTDLP_INFO_OPTS = _build_info_opts()
+
+
+def _build_download_opts():
+    """Build the yt-dlp options shared by every download once, after tool detection"""
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'noplaylist': True,
+        'socket_timeout': 30,
+        'http_headers': YTDLP_HTTP_HEADERS,
+        'concurrent_fragment_downloads': YTDLP_CONCURRENT_FRAGMENTS,
+    }
+    
+    # Use Node.js as JavaScript runtime when it was found at startup
+    if NODE_PATH:
+        opts['js_runtimes'] = {'node': {'path': NODE_PATH}}
+    
+    # Point yt-dlp at ffmpeg when it is not on PATH (e.g. WinGet install on Windows)
+    if FFMPEG_PATH and os.path.dirname(FFMPEG_PATH):
+        opts['ffmpeg_location'] = FFMPEG_PATH
+    
+    return opts
+
+
+YTDLP_DOWNLOAD_OPTS = _build_download_opts()
+
+
+def _download_tmp_root():
+    """
+    Pick the directory downloads are staged in
+    
+    Downloads are written once, read once and deleted, so a RAM-backed tmpfs
+    (/dev/shm) avoids disk I/O entirely. Small tmpfs mounts (Docker defaults to
+    64 MB) are skipped. DOWNLOAD_TMP_DIR overrides the choice.
+    """
+    override = os.environ.get('DOWNLOAD_TMP_DIR')
+    if override:
+        return override
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK) and shutil.disk_usage(shm).total >= MIN_TMPFS_SIZE:
+        return shm
+    return tempfile.gettempdir()
+
+
+DOWNLOAD_TMP_ROOT = _download_tmp_root()
+
+# Staging dirs are created with this prefix so stale ones can be recognised after a crash or restart
+TEMP_DIR_PREFIX = 'ytdl-'
+# Anything older than this is left over from a previous process (jobs are kept for DOWNLOAD_JOB_TTL)
+STALE_TEMP_DIR_AGE = 2 * DOWNLOAD_JOB_TTL
+# Long-running workers re-sweep this often, catching dirs leaked by workers that were killed
+# mid-download (gunicorn timeouts, OOM) without waiting for the next restart
+TEMP_SWEEP_INTERVAL = 600  # seconds
+
+# Temp dirs are removed by a background thread, so deleting a large download never holds up a worker.
+# It also sweeps for stale dirs every TEMP_SWEEP_INTERVAL, busy or not.
+# The thread is started on first use: with gunicorn's preload_app the module is imported in the
+# master, and threads started there don't survive the fork into workers.
+_cleanup_queue = queue.SimpleQueue()
+_cleanup_thread = None
+_cleanup_thread_lock = threading.Lock()
+
+
+def _cleanup_worker():
+    last_sweep = time.monotonic()
+    while True:
+        try:
+            path = _cleanup_queue.get(timeout=max(0, last_sweep + TEMP_SWEEP_INTERVAL - time.monotonic()))
+        except queue.Empty:
+            path = None
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+        # Sweep on schedule even while downloads keep the queue busy
+        if time.monotonic() - last_sweep >= TEMP_SWEEP_INTERVAL:
+            last_sweep = time.monotonic()
+            sweep_stale_temp_dirs()
+
+
+def schedule_cleanup(path):
+    """Queue a temp dir for removal by the background cleanup thread"""
+    global _cleanup_thread
+    _cleanup_queue.put(path)
+    if _cleanup_thread is None or not _cleanup_thread.is_alive():
+        with _cleanup_thread_lock:
+            if _cleanup_thread is None or not _cleanup_thread.is_alive():
+                _cleanup_thread = threading.Thread(target=_cleanup_worker, name='temp-cleanup', daemon=True)
+                _cleanup_thread.start()
+
+
+def sweep_stale_temp_dirs():
+    """Queue staging dirs left behind by earlier processes for removal"""
+    cutoff = time.time() - STALE_TEMP_DIR_AGE
+    try:
+        with os.scandir(DOWNLOAD_TMP_ROOT) as entries:
+            for entry in entries:
+                if entry.name.startswith(TEMP_DIR_PREFIX) and entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                    schedule_cleanup(entry.path)
+    except OSError as e:
+        print(f"Could not sweep {DOWNLOAD_TMP_ROOT}: {e}")
+
+
+sweep_stale_temp_dirs()
+
+# Behind nginx, set ACCEL_REDIRECT_PREFIX to an `internal` location aliased to DOWNLOAD_TMP_DIR
+# (e.g. /protected-downloads/) and nginx will transmit finished downloads instead of the worker
+ACCEL_REDIRECT_PREFIX = os.environ.get('ACCEL_REDIRECT_PREFIX')
+# nginx opens the file as soon as it sees the header, and an open file outlives its directory,
+# so the temp dir only has to survive that hand-off
+ACCEL_REDIRECT_CLEANUP_DELAY = 60  # seconds
+
+
+def get_ydl():
+    """
+    Return the YoutubeDL instance used for metadata extraction.
+
+    One instance is built per thread and reused across requests, so the
+    yt-dlp import, extractor registry and HTTP connections are paid for once
+    instead of on every call (YoutubeDL is not safe to share across threads).
+    """
+    ydl = getattr(_ydl_local, 'ydl', None)
+    if ydl is None:
+        ydl = YoutubeDL(dict(YTDLP_INFO_OPTS))  # YoutubeDL mutates its params
+        _ydl_local.ydl = ydl
+    return ydl
+
+
+def warm_up_ydl():
+    """
+    Load the YouTube extractor at import time
+    
+    yt-dlp imports extractor modules lazily on first use. Doing it here means that
+    under gunicorn's preload_app it happens once in the master and is shared with
+    every worker, instead of being paid by the first request in each process.
+    """
+    try:
+        YoutubeDL(dict(YTDLP_INFO_OPTS)).get_info_extractor('Youtube')
+    except Exception as e:
+        print(f"yt-dlp warm-up failed: {e}")
+
+
+warm_up_ydl()
+
+
+def canonical_youtube_url(url):
+    """
+    Validate a YouTube URL and return its canonical form, or None if it is not a YouTube URL
+    
+    Video links of any shape (youtu.be, shorts, embed, live, watch with extra params, including
+    a playlist's list=) become https://www.youtube.com/watch?v=<id>.
+    """
+    match = YOUTUBE_URL_RE.match(url)
+    if not match:
+        return None
+    return f'https://www.youtube.com/watch?v={match.group(1)}'
+
+
+def require_youtube_url(url):
+    """
+    Return the canonical form of a YouTube URL taken from a request
+    
+    Anything that isn't a YouTube URL is rejected here, before a yt-dlp extraction
+    is spent on it.
+    
+    Raises:
+        Exception: If the URL is not http(s) or not a YouTube URL (reported as 400)
+    """
+    if not url.startswith(('http://', 'https://')):
+        raise Exception('Invalid URL format. URL must start with http:// or https://')
+    canonical = canonical_youtube_url(url)
+    if not canonical:
+        raise Exception('Only YouTube URLs are supported')
+    return canonical
+
+
+def video_cache_key(url):
+    """Return the cache key for a canonical YouTube URL (see require_youtube_url): its video ID"""
+    return YOUTUBE_URL_RE.match(url).group(1)
+
+
+def cached_video_info(url):
+    """Return the cached video information for a URL, or None without extracting on a miss"""
+    cached = _video_info_cache.get(video_cache_key(url))
+    if isinstance(cached, Exception):
+        raise Exception(str(cached))
+    return cached
+
 
 def get_video_info(url):
     """
-    Extract video information using yt-dlp --dump-json
+    Return video information for a URL, served from the TTL cache when possible
     
     Args:
         url: YouTube video URL
@@ -75,403 +549,1004 @@ def get_video_info(url):
         dict: Video information including title and formats
     
     Raises:
-        Exception: For various error scenarios
+        Exception: If extraction fails (recent failures are re-raised from the cache)
     """
+    key = video_cache_key(url)
+    cached = _video_info_cache.get(key)
+    if isinstance(cached, Exception):
+        raise Exception(str(cached))
+    if cached is not None:
+        return cached
+    
+    with _inflight_extractions_lock:
+        future = _inflight_extractions.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight_extractions[key] = future
+    
+    if not is_owner:
+        try:
+            return future.result(timeout=EXTRACTION_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            raise ServerBusyError('The server is busy right now. Please try again in a few seconds.')
+        except ServerBusyError:
+            raise
+        except Exception as e:
+            raise Exception(str(e))
+    
     try:
-        # Enhanced yt-dlp command with comprehensive browser-like headers for Render
-        cmd = [
-            'python', '-m', 'yt_dlp',
-            '--dump-json',
-            '--no-playlist',
-            '--no-warnings',
-            '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            '--add-header', 'Accept:text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            '--add-header', 'Accept-Language:en-US,en;q=0.9',
-            '--add-header', 'Accept-Encoding:gzip, deflate, br',
-            '--add-header', 'DNT:1',
-            '--add-header', 'Connection:keep-alive',
-            '--add-header', 'Upgrade-Insecure-Requests:1',
-            '--add-header', 'Sec-Fetch-Dest:document',
-            '--add-header', 'Sec-Fetch-Mode:navigate',
-            '--add-header', 'Sec-Fetch-Site:none',
-            '--add-header', 'Cache-Control:max-age=0',
-            '--extractor-args', 'youtube:player_skip=js'  # Skip JS player to avoid bot detection
-        ]
-        
-        # Try to find Node.js for JavaScript runtime (important for Render)
-        node_paths = ['node', '/usr/bin/node', '/usr/local/bin/node', '/opt/render/project/node_modules/.bin/node']
-        node_found = False
-        for node_path in node_paths:
-            try:
-                result = subprocess.run([node_path, '--version'], capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    cmd.extend(['--js-runtimes', node_path])
-                    node_found = True
-                    print(f"Found Node.js at: {node_path}")
-                    break
-            except:
-                continue
-        
-        if not node_found:
-            print("Node.js not found, using fallback extraction method")
-        
-        cmd.append(url)
-        
-        # Run yt-dlp with enhanced options
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=60  # Increased timeout for Render
-        )
-        
-        if result.returncode != 0:
-            error_msg = result.stderr.strip()
-            if 'Video unavailable' in error_msg:
-                raise Exception('Video is unavailable. It may have been removed or made private.')
-            elif 'Private video' in error_msg:
-                raise Exception('This video is private and cannot be downloaded.')
-            elif 'This video is not available' in error_msg:
-                raise Exception('This video is not available in your region.')
-            elif 'Sign in to confirm your age' in error_msg:
-                raise Exception('This video is age-restricted and cannot be downloaded.')
-            elif 'members-only' in error_msg:
-                raise Exception('This video is only available to channel members.')
-            elif 'Sign in to confirm' in error_msg:
-                raise Exception('YouTube requires authentication for this video. This may be due to regional restrictions or the video being age-restricted. Try a different video or check if the video is publicly accessible.')
-            elif 'No supported JavaScript runtime' in error_msg:
-                raise Exception('Video extraction failed due to YouTube\'s anti-bot measures. This is a temporary issue - please try again later or try a different video.')
-            else:
-                raise Exception(f'Failed to fetch video information: {error_msg}')
-        
-        # Parse JSON output
-        video_info = json.loads(result.stdout)
+        with youtube_slot():
+            video_info = extract_video_info(url)
+    except Exception as e:
+        if not isinstance(e, ServerBusyError) and not any(marker in str(e).lower() for marker in TRANSIENT_ERROR_MARKERS):
+            _video_info_cache.set(key, e, VIDEO_INFO_ERROR_TTL)
+        future.set_exception(e)
+        raise
+    else:
+        _video_info_cache.set(key, video_info, VIDEO_INFO_CACHE_TTL)
+        future.set_result(video_info)
         return video_info
+    finally:
+        with _inflight_extractions_lock:
+            del _inflight_extractions[key]
+
+
+def find_cause(error, exc_type):
+    """Return the first exception of exc_type in a yt-dlp error chain (DownloadError -> ExtractorError -> cause), or None"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, exc_type):
+            return error
+        seen.add(id(error))
+        error = getattr(error, 'cause', None) or (getattr(error, 'exc_info', None) or (None, None))[1]
+    return None
+
+
+def slim_video_info(video_info):
+    """Drop the info keys and storyboard formats this app never uses"""
+    for key in UNUSED_INFO_KEYS:
+        video_info.pop(key, None)
+    # Storyboards are image sprites (no video or audio codec) that can't be downloaded as video
+    video_info['formats'] = [fmt for fmt in video_info.get('formats') or [] if fmt.get('protocol') != 'mhtml']
+    return video_info
+
+
+def extract_video_info(url):
+    """
+    Extract video information using the in-process yt-dlp library
+    
+    Args:
+        url: YouTube video URL
+    
+    Returns:
+        dict: Video information including title and formats
+    
+    Raises:
+        Exception: For various error scenarios
+    """
+    try:
+        video_info = get_ydl().extract_info(url, download=False)
+        # Same JSON-compatible dict that `yt-dlp --dump-json` used to print
+        return slim_video_info(YoutubeDL.sanitize_info(video_info))
         
-    except subprocess.TimeoutExpired:
-        raise Exception('Request timed out. Please try again.')
-    except json.JSONDecodeError:
-        raise Exception('Failed to parse video information.')
-    except FileNotFoundError:
-        raise Exception('yt-dlp is not installed. Please install it first.')
+    except DownloadError as e:
+        error_msg = str(e).strip()
+        rate_limited = find_cause(e, HTTPError)
+        if find_cause(e, GeoRestrictedError):
+            raise Exception('This video is not available in your region.')
+        elif rate_limited and rate_limited.status == 429:
+            raise Exception('YouTube is rate limiting network requests from this server. Please try again in a few minutes.')
+        elif find_cause(e, TransportError):
+            raise Exception('Network error while contacting YouTube. Please try again.')
+        elif 'Video unavailable' in error_msg:
+            raise Exception('Video is unavailable. It may have been removed or made private.')
+        elif 'Private video' in error_msg:
+            raise Exception('This video is private and cannot be downloaded.')
+        elif 'This video is not available' in error_msg:
+            raise Exception('This video is not available in your region.')
+        elif 'Sign in to confirm your age' in error_msg:
+            raise Exception('This video is age-restricted and cannot be downloaded.')
+        elif 'members-only' in error_msg:
+            raise Exception('This video is only available to channel members.')
+        elif 'Sign in to confirm' in error_msg:
+            raise Exception('YouTube requires authentication for this video. This may be due to regional restrictions or the video being age-restricted. Try a different video or check if the video is publicly accessible.')
+        elif 'No supported JavaScript runtime' in error_msg:
+            raise Exception('Video extraction failed due to YouTube\'s anti-bot measures. This is a temporary issue - please try again later or try a different video.')
+        elif 'timed out' in error_msg:
+            raise Exception('Request timed out. Please try again.')
+        else:
+            raise Exception(f'Failed to fetch video information: {error_msg}')
     except Exception as e:
-        if str(e).startswith('Video is') or str(e).startswith('This video') or str(e).startswith('Failed to'):
-            raise
         raise Exception(f'An unexpected error occurred: {str(e)}')
 
 
-@app.route('/api/qualities', methods=['POST'])
-def get_qualities():
-    """Fetch available video qualities for a YouTube URL"""
+def find_direct_formats(video_info, format_id, protocols=DIRECT_PROTOCOLS):
+    """
+    Return the format dicts for format_id if every part has a URL fetched over one of protocols
+    
+    With the default (plain HTTP(S)) such formats can be fetched straight from YouTube
+    without staging them on disk. Returns one dict for a single format and two for a
+    merged selector (video+audio). Other protocols and unknown ids return None.
+    """
+    formats_by_id = {fmt.get('format_id'): fmt for fmt in video_info.get('formats', [])}
+    direct_formats = []
+    for part in format_id.split('+'):
+        fmt = formats_by_id.get(part)
+        if not fmt or not fmt.get('url') or fmt.get('protocol') not in protocols:
+            return None
+        direct_formats.append(fmt)
+    return direct_formats
+
+
+def open_format_range(fmt, start, range_size):
+    """Open an HTTP request for a byte range of a format, or return None past the end of the file"""
+    headers = dict(fmt.get('http_headers') or YTDLP_HTTP_HEADERS)
+    end = start + range_size - 1 if range_size else ''
+    headers['Range'] = f'bytes={start}-{end}'
+    upstream = HTTP_SESSION.get(fmt['url'], headers=headers, stream=True, timeout=UPSTREAM_TIMEOUT)
+    if upstream.status_code == 416:
+        upstream.close()
+        return None
     try:
-        data = request.get_json()
-        url = data.get('url')
-        
-        if not url:
-            return jsonify({'error': 'URL is required'}), 400
-        
-        # Validate URL format (basic check)
-        if not url.startswith(('http://', 'https://')):
-            return jsonify({'error': 'Invalid URL format. URL must start with http:// or https://'}), 400
-        
-        # Get video information using yt-dlp
-        video_info = get_video_info(url)
-        
-        title = video_info.get('title', 'Unknown Title')
-        thumbnail = video_info.get('thumbnail', '')
-        formats = video_info.get('formats', [])
-        
-        # Filter and process formats - prefer formats with both video and audio combined
-        processed_formats = []
-        seen_resolutions = {}
+        upstream.raise_for_status()
+    except requests.HTTPError:
+        upstream.close()
+        raise
+    return upstream
+
+
+def stream_format(fmt, start=0, end=None):
+    """
+    Return a generator over the bytes of a direct-URL format, from start up to end (inclusive)
+    
+    YouTube throttles long unranged requests, so the file is fetched in the same
+    range sizes yt-dlp would use. The first request is opened eagerly so that
+    errors surface before the response starts, and closing the generator closes
+    it even if iteration never started.
+    """
+    range_size = (fmt.get('downloader_options') or {}).get('http_chunk_size')
+    
+    def range_length(position):
+        if end is None:
+            return range_size
+        remaining = end - position + 1
+        return min(range_size, remaining) if range_size else remaining
+    
+    def generate():
+        position = start
+        size = range_length(position)
+        upstream = open_format_range(fmt, position, size)
+        try:
+            yield b''  # First range opened; stream_format() primes the generator up to here
+            while upstream is not None:
+                received = 0
+                with upstream:
+                    for chunk in upstream.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                        received += len(chunk)
+                        yield chunk
+                position += received
+                if not size or received < size or position == fmt.get('filesize') or (end is not None and position > end):
+                    break
+                size = range_length(position)
+                upstream = open_format_range(fmt, position, size)
+        finally:
+            if upstream is not None:
+                upstream.close()
+    
+    body = generate()
+    next(body)
+    return body
+
 
-        # Collect audio-only formats and best audio per container
-        audio_formats = []
-        best_audio_by_ext = {}
-        best_audio_overall = None
-        video_formats = []
+def can_remux_formats(formats):
+    """Return True if stream_remuxed_formats() can handle these formats on this host"""
+    if not formats or len(formats) > 2 or not FFMPEG_PATH:
+        return False
+    # Plain HTTP(S) inputs are fed to ffmpeg through named pipes
+    return hasattr(os, 'mkfifo') or all(fmt.get('protocol') in FFMPEG_STREAM_PROTOCOLS for fmt in formats)
 
+
+def stream_remuxed_formats(formats):
+    """
+    Return a generator over one or two formats remuxed by ffmpeg into a fragmented MP4
+    
+    HLS formats are read by ffmpeg itself. Plain HTTP(S) formats are fetched with
+    stream_format() and fed to ffmpeg through named pipes. Streams are copied without
+    re-encoding and the output is read from ffmpeg's stdout, so bytes reach the client
+    while the download is still running instead of after a full download and merge on disk.
+    A pair is muxed as video from the first format and audio from the second.
+    
+    The generator is primed until ffmpeg's first output arrives. If ffmpeg exits without
+    writing anything (bad input, failed HLS fetch), OSError is raised instead, so the
+    caller can fall back to a staged download rather than send an empty file.
+    """
+    bodies = []
+    fifo_dir = None
+    fifos = []
+    feeds = []
+    input_args = []
+    proc = None
+    try:
+        # Open the upstream requests first so that errors surface before anything is started
         for fmt in formats:
-            vcodec = fmt.get('vcodec', 'none')
-            acodec = fmt.get('acodec', 'none')
-            ext = fmt.get('ext')
-            height = fmt.get('height')
-
-            # Collect audio-only formats
-            if acodec and acodec != 'none' and (not vcodec or vcodec == 'none'):
-                audio_formats.append(fmt)
-                key = ext or 'default'
-                current = best_audio_by_ext.get(key)
-                abr = fmt.get('abr') or 0
-                if not current or abr > (current.get('abr') or 0):
-                    best_audio_by_ext[key] = fmt
-                if not best_audio_overall or abr > (best_audio_overall.get('abr') or 0):
-                    best_audio_overall = fmt
-
-            # Collect video formats (with video codec)
-            if vcodec and vcodec != 'none':
-                video_formats.append(fmt)
-
-        # Process video formats and combine with the best matching audio
-        for fmt in video_formats:
-            format_id = fmt.get('format_id')
-            ext = fmt.get('ext')
-            acodec = fmt.get('acodec', 'none')
-            height = fmt.get('height', 0)
-
-            # Skip if no height info
-            if not height or height == 0:
+            bodies.append(stream_format(fmt) if fmt.get('protocol') in DIRECT_PROTOCOLS else None)
+        for fmt, body in zip(formats, bodies):
+            if body is None:
+                headers = fmt.get('http_headers') or YTDLP_HTTP_HEADERS
+                input_args += ['-headers', ''.join(f'{name}: {value}\r\n' for name, value in headers.items()), '-i', fmt['url']]
                 continue
+            if fifo_dir is None:
+                fifo_dir = tempfile.mkdtemp(prefix=TEMP_DIR_PREFIX, dir=DOWNLOAD_TMP_ROOT)
+            fifo = os.path.join(fifo_dir, f'input{len(fifos)}')
+            os.mkfifo(fifo)
+            fifos.append(fifo)
+            feeds.append((body, fifo))
+            input_args += ['-i', fifo]
+        map_args = ['-map', '0'] if len(formats) == 1 else ['-map', '0:v:0', '-map', '1:a:0']
+        
+        proc = subprocess.Popen(
+            [FFMPEG_PATH, '-loglevel', 'error', *input_args, *map_args, '-c', 'copy',
+             '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4', 'pipe:1'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except Exception:
+        # Nothing reads from the fifos yet, so no feeder is blocked; just release what was opened
+        for body in bodies:
+            if body is not None:
+                body.close()
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+        if fifo_dir:
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+        raise
+    
+    def feed(body, fifo):
+        try:
+            with open(fifo, 'wb') as pipe:
+                for chunk in body:
+                    pipe.write(chunk)
+        except (OSError, requests.RequestException) as e:
+            # ffmpeg exited early (client went away) or the upstream request failed
+            print(f"Stopped feeding {os.path.basename(fifo)} to ffmpeg: {e}")
+        finally:
+            body.close()
+    
+    for body, fifo in feeds:
+        threading.Thread(target=feed, args=(body, fifo), daemon=True).start()
+    
+    # Drain stderr (kept short by -loglevel error) so it can be logged if ffmpeg fails
+    stderr_output = []
+    stderr_reader = threading.Thread(target=lambda: stderr_output.append(proc.stderr.read()), daemon=True)
+    stderr_reader.start()
+    
+    def generate():
+        try:
+            chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                raise OSError(f'ffmpeg exited with status {proc.wait()} without any output')
+            yield b''  # Primed below once ffmpeg has produced output; closing the generator always runs the cleanup
+            while chunk:
+                yield chunk
+                chunk = proc.stdout.read(STREAM_CHUNK_SIZE)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+            stderr_reader.join(timeout=5)
+            proc.stderr.close()
+            # Killed above when the client went away (negative status); anything else is ffmpeg failing
+            if proc.returncode > 0:
+                print(f"ffmpeg exited with status {proc.returncode}: {b''.join(stderr_output).decode(errors='replace').strip()}")
+            # Open the read ends so feeders still blocked opening a fifo get EPIPE instead of hanging
+            for fifo in fifos:
+                try:
+                    os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            if fifo_dir:
+                shutil.rmtree(fifo_dir, ignore_errors=True)
+    
+    body = generate()
+    next(body)
+    return body
+
+
+def hold_download_slot(open_stream, *args):
+    """
+    Call open_stream(*args) while holding a download slot, and keep the slot until the stream is closed
+    
+    Proxied and remuxed downloads talk to YouTube's CDN for as long as they run, so they
+    count against DOWNLOAD_CONCURRENCY like staged downloads. Raises ServerBusyError if no
+    slot frees up in time.
+    """
+    def generate():
+        with youtube_slot(_download_semaphore):
+            body = open_stream(*args)
+            try:
+                yield b''  # Slot taken and stream opened; primed below
+                yield from body
+            finally:
+                body.close()
+    
+    stream = generate()
+    next(stream)
+    return stream
 
-            resolution = f"{height}p"
 
-            # Calculate total filesize
-            filesize = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+def attachment_disposition(filename):
+    """Build a Content-Disposition header value that is safe for non-ASCII filenames"""
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        return f'attachment; filename="{simple}"; filename*=UTF-8\'\'{quote(filename, safe="")}'
 
-            # Prefer audio that matches the container (webm/mp4), fallback to best overall
-            audio_match = best_audio_by_ext.get(ext) or best_audio_overall
 
-            # If format doesn't have audio, add matched audio
-            if not acodec or acodec == 'none':
-                if audio_match:
-                    audio_filesize = audio_match.get('filesize') or audio_match.get('filesize_approx') or 0
-                    filesize = filesize + audio_filesize
-                    combined_id = f"{format_id}+{audio_match.get('format_id')}"
-                else:
-                    continue
-            else:
-                combined_id = format_id
-
-            # Skip duplicate resolutions (keep the best quality for each resolution)
-            if resolution in seen_resolutions:
-                prev_filesize = seen_resolutions[resolution]['filesize']
-                if filesize <= prev_filesize:
-                    continue
-                # Remove previous entry for this resolution
-                processed_formats = [f for f in processed_formats if f['resolution'] != resolution]
-
-            seen_resolutions[resolution] = {'filesize': filesize}
-            filesize_mb = round(filesize / (1024 * 1024), 2) if filesize > 0 else 0
-
-            processed_formats.append({
-                'format_id': combined_id,
-                'resolution': resolution,
-                'ext': ext or 'mp4',
-                'filesize': filesize,
-                'filesize_mb': filesize_mb
+def check_staging_space(video_info, format_id):
+    """
+    Raise ServerBusyError if the staging dir can't hold this download right now
+    
+    On a tmpfs a download that doesn't fit fails part-way after eating the box's memory,
+    so it is turned away up front instead. Merged formats need room for the separate
+    streams and the merged file at the same time.
+    """
+    formats_by_id = {fmt.get('format_id'): fmt for fmt in video_info.get('formats', [])}
+    parts = [formats_by_id.get(part) or {} for part in format_id.split('+')]
+    expected = sum(fmt.get('filesize') or fmt.get('filesize_approx') or 0 for fmt in parts)
+    if len(parts) > 1:
+        expected *= 2
+    if expected and shutil.disk_usage(DOWNLOAD_TMP_ROOT).free < expected:
+        raise ServerBusyError('Not enough space to prepare this download right now. Please try again later or pick a lower quality.')
+
+
+def download_to_dir(video_info, format_id, temp_dir, progress_hook=None):
+    """
+    Download a format of an already extracted video into temp_dir using yt-dlp
+    
+    Args:
+        video_info: Video information from get_video_info
+        format_id: yt-dlp format selector (e.g. '18' or '137+140')
+        temp_dir: Directory to download into
+        progress_hook: Optional yt-dlp progress hook
+    
+    Returns:
+        str: Path of the downloaded file
+    
+    Raises:
+        ServerBusyError: If there is not enough space to stage the download
+        Exception: If the download fails or takes longer than DOWNLOAD_TIMEOUT
+    """
+    check_staging_space(video_info, format_id)
+    
+    # Download using yt-dlp with specific format
+    output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
+
+    requires_merge = '+' in format_id
+    ffmpeg_path = FFMPEG_PATH
+    has_ffmpeg = ffmpeg_path is not None
+    
+    deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+    
+    def check_deadline(d):
+        # Exceptions raised by progress hooks abort the download
+        if time.monotonic() > deadline:
+            raise Exception(DOWNLOAD_TIMEOUT_ERROR)
+    
+    # Per-download options on top of the shared ones (a fresh dict, since YoutubeDL mutates its params)
+    ydl_opts = {**YTDLP_DOWNLOAD_OPTS, 'format': format_id, 'outtmpl': output_template}
+    ydl_opts['progress_hooks'] = [check_deadline, progress_hook] if progress_hook else [check_deadline]
+    
+    if requires_merge:
+        if ARIA2C_PATH:
+            # Fetch the video and audio streams over multiple parallel connections
+            ydl_opts['external_downloader'] = {'default': ARIA2C_PATH}
+            ydl_opts['external_downloader_args'] = {'aria2c': ARIA2C_ARGS}
+        if has_ffmpeg:
+            # Ensure audio and video are merged into mp4 with ffmpeg
+            ydl_opts.update({
+                'merge_output_format': 'mp4',
+                'postprocessor_args': {'ffmpeg': ['-c', 'copy']},
+                'keepvideo': False  # Don't keep separate video/audio files
             })
-        
-        # Sort by resolution (descending)
-        def get_resolution_number(fmt):
-            """Extract numeric resolution value, return 0 if not found"""
-            try:
-                res = fmt['resolution']
-                if res == 'unknown':
-                    return 0
-                match = re.search(r'(\d+)', res)
-                return int(match.group(1)) if match else 0
-            except (ValueError, KeyError, AttributeError):
-                return 0
-        
-        processed_formats.sort(key=get_resolution_number, reverse=True)
-        
-        if not processed_formats:
-            return jsonify({'error': 'No downloadable video formats found for this video'}), 422
-        
-        return jsonify({
-            'title': title,
-            'thumbnail': thumbnail,
-            'formats': processed_formats
-        })
+        else:
+            # Use yt-dlp's built-in merger without explicit ffmpeg
+            ydl_opts['merge_output_format'] = 'mkv'  # Use mkv as fallback if no ffmpeg
     
-    except Exception as e:
-        error_message = str(e)
-        status_code = 400
-        
-        if 'unavailable' in error_message.lower() or 'removed' in error_message.lower():
-            status_code = 404
-        elif 'private' in error_message.lower() or 'region' in error_message.lower() or 'age-restricted' in error_message.lower() or 'members' in error_message.lower():
-            status_code = 403
-        elif 'timeout' in error_message.lower() or 'network' in error_message.lower():
-            status_code = 503
-        
-        return jsonify({'error': error_message}), status_code
+    print(f"Downloading format {format_id} of {video_info.get('webpage_url')}")  # Debug logging
+    print(f"FFmpeg available: {has_ffmpeg}, path: {ffmpeg_path}")  # Debug logging
+    
+    try:
+        with youtube_slot(_download_semaphore), YoutubeDL(ydl_opts) as ydl:
+            # Download from the already extracted info (like `--load-info-json`) instead of
+            # extracting again; work on a copy since yt-dlp mutates it and it is shared via the cache
+            result = ydl.process_ie_result(copy.deepcopy(video_info), download=True)
+    except DownloadError as e:
+        error_msg = str(e).strip()
+        print(f"yt-dlp error: {error_msg}")
+        if time.monotonic() > deadline:
+            raise Exception(DOWNLOAD_TIMEOUT_ERROR)
+        raise Exception(f'Download failed: {error_msg}')
+    
+    # yt-dlp records the final path (after merging/moving) of each download it made
+    requested = result.get('requested_downloads') or [{}]
+    output_path = requested[-1].get('filepath')
+    if not output_path or not os.path.isfile(output_path):
+        raise Exception('Download completed but file not found')
+    
+    print(f"Downloaded file: {output_path}")  # Debug logging
+    return output_path
+
+
+def send_downloaded_file(output_path, temp_dir, safe_title):
+    """Build the attachment response for a downloaded file; temp_dir is removed once it has been sent (or handed to nginx)"""
+    # Get file extension
+    _, ext = os.path.splitext(output_path)
+    if not ext:
+        ext = '.mp4'
+    
+    if ACCEL_REDIRECT_PREFIX:
+        # nginx sends the file (sendfile, range requests) and the worker is free immediately
+        relative_path = os.path.relpath(output_path, DOWNLOAD_TMP_ROOT).replace(os.sep, '/')
+        response = Response(mimetype='application/octet-stream')
+        response.headers['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relative_path)
+        response.headers['Content-Disposition'] = attachment_disposition(f'{safe_title}{ext}')
+        cleanup = threading.Timer(ACCEL_REDIRECT_CLEANUP_DELAY, schedule_cleanup, args=(temp_dir,))
+        cleanup.daemon = True
+        cleanup.start()
+    else:
+        # Let the WSGI server's file wrapper (sendfile on gunicorn) stream the file.
+        # The temp dir is removed when the server closes the file after sending it.
+        download_file = TempDirFile(output_path, temp_dir)
+        size = os.fstat(download_file.fileno()).st_size
+        response = send_file(
+            download_file,
+            mimetype='application/octet-stream',
+            as_attachment=True,
+            download_name=f'{safe_title}{ext}',
+            conditional=False
+        )
+        response.content_length = size
+        # send_file can't size a file object, so it would ignore Range; answer it with the known size
+        try:
+            response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+        except RequestedRangeNotSatisfiable:
+            response.close()
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+    
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    
+    return response
+
+
+# Status code for an error message, by the first group with a matching substring (checked in order)
+ERROR_STATUS_CODES = (
+    (('download timed out',), 408),
+    (('unavailable', 'removed'), 404),
+    (('private', 'region', 'age-restricted', 'members'), 403),
+    (('timeout', 'network'), 503),
+    (('no downloadable video formats',), 422),
+)
+
+
+def error_status_code(error_message):
+    """Map an error message to an HTTP status code, defaulting to 400"""
+    lowered = error_message.lower()
+    return next((status for markers, status in ERROR_STATUS_CODES if any(marker in lowered for marker in markers)), 400)
+
+
+def api_error_handler(view):
+    """Turn an exception raised by an API view into a JSON error response with a matching status code"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except ServerBusyError as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(BUSY_RETRY_AFTER)
+            return response
+        except Exception as e:
+            error_message = str(e)
+            return jsonify({'error': error_message}), error_status_code(error_message)
+    
+    return wrapper
+
+
+def take_rate_limit_token(client, cost=1):
+    """Take cost tokens from the client's bucket; return 0 on success, else seconds until they are available"""
+    now = time.monotonic()
+    refill_rate = RATE_LIMIT_PER_MINUTE / 60
+    with _rate_buckets_lock:
+        tokens, updated_at = _rate_buckets.get(client, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - updated_at) * refill_rate)
+        if tokens < cost:
+            _rate_buckets[client] = (tokens, now)
+            return (cost - tokens) / refill_rate
+        _rate_buckets[client] = (tokens - cost, now)
+        if len(_rate_buckets) > RATE_LIMIT_MAX_CLIENTS:
+            # Forget clients whose buckets have refilled; they'd start full anyway
+            full_after = RATE_LIMIT_BURST / refill_rate
+            for key in [key for key, (_, seen) in _rate_buckets.items() if now - seen >= full_after]:
+                del _rate_buckets[key]
+    return 0
 
-@app.route('/api/download', methods=['POST'])
+
+@app.before_request
+def rate_limit():
+    """Reject clients that exceed their request budget on the YouTube-backed endpoints"""
+    # CORS preflights resolve to the same endpoints but never reach YouTube
+    if request.endpoint not in RATE_LIMITED_ENDPOINTS or request.method == 'OPTIONS':
+        return None
+    retry_after = take_rate_limit_token(request.remote_addr)
+    if retry_after:
+        return rate_limited_response(retry_after)
+    return None
+
+
+def rate_limited_response(retry_after):
+    """Build the 429 response for a client that is out of tokens"""
+    response = jsonify({'error': 'Too many requests. Please wait a moment and try again.'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+
+NO_FORMATS_ERROR = 'No downloadable video formats found for this video'
+
+
+def qualities_response(url):
+    """
+    Return the serialized /api/qualities body and its ETag for a canonical YouTube URL
+    
+    Responses are cached per video, so repeat queries skip the extraction, the format
+    processing and the JSON encoding.
+    
+    Raises:
+        Exception: If extraction fails or the video has no downloadable formats
+    """
+    cache_key = video_cache_key(url)
+    cached = _qualities_response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    qualities = video_qualities(get_video_info(url))
+    if not qualities['formats']:
+        raise Exception(NO_FORMATS_ERROR)
+    
+    response = app.json.response(qualities)
+    response.add_etag()
+    etag, _ = response.get_etag()
+    cached = (response.get_data(), etag)
+    _qualities_response_cache.set(cache_key, cached, VIDEO_INFO_CACHE_TTL)
+    return cached
+
+
+def video_qualities(video_info):
+    """Build the /api/qualities payload (title, thumbnail, formats) for extracted video info"""
+    return {
+        'title': video_info.get('title', 'Unknown Title'),
+        'thumbnail': video_info.get('thumbnail', ''),
+        'formats': list_qualities(video_info.get('formats', []))
+    }
+
+
+def list_qualities(formats):
+    """
+    Pick one download option per resolution from yt-dlp's formats
+    
+    Video-only formats are paired with the best audio (same container preferred),
+    and the largest candidate is kept for each height.
+    
+    Returns:
+        list: Quality dicts (format_id, resolution, ext, filesize, filesize_mb), highest first
+    """
+    # Collect best audio per container and the video formats in a single pass
+    best_audio_by_ext = {}
+    best_audio_overall = None
+    video_formats = []
+
+    for fmt in formats:
+        vcodec = fmt.get('vcodec', 'none')
+        acodec = fmt.get('acodec', 'none')
+        ext = fmt.get('ext')
+
+        # Track best audio-only formats
+        if acodec and acodec != 'none' and (not vcodec or vcodec == 'none'):
+            key = ext or 'default'
+            current = best_audio_by_ext.get(key)
+            abr = fmt.get('abr') or 0
+            if not current or abr > (current.get('abr') or 0):
+                best_audio_by_ext[key] = fmt
+            if not best_audio_overall or abr > (best_audio_overall.get('abr') or 0):
+                best_audio_overall = fmt
+
+        # Collect video formats (with video codec)
+        if vcodec and vcodec != 'none':
+            video_formats.append(fmt)
+
+    # Combine video formats with the best matching audio, keeping the
+    # largest (best quality) candidate per height
+    best_by_height = {}
+
+    for fmt in video_formats:
+        format_id = fmt.get('format_id')
+        ext = fmt.get('ext')
+        acodec = fmt.get('acodec', 'none')
+        height = fmt.get('height', 0)
+
+        # Skip if no height info
+        if not height or height == 0:
+            continue
+
+        # Calculate total filesize
+        filesize = fmt.get('filesize') or fmt.get('filesize_approx') or 0
+
+        # Prefer audio that matches the container (webm/mp4), fallback to best overall
+        audio_match = best_audio_by_ext.get(ext) or best_audio_overall
+
+        # If format doesn't have audio, add matched audio
+        if not acodec or acodec == 'none':
+            if audio_match:
+                audio_filesize = audio_match.get('filesize') or audio_match.get('filesize_approx') or 0
+                filesize = filesize + audio_filesize
+                combined_id = f"{format_id}+{audio_match.get('format_id')}"
+            else:
+                continue
+        else:
+            combined_id = format_id
+
+        # Skip duplicate resolutions (keep the best quality for each resolution)
+        current = best_by_height.get(height)
+        if current and filesize <= current['filesize']:
+            continue
+
+        best_by_height[height] = {
+            'format_id': combined_id,
+            'resolution': f"{height}p",
+            'ext': ext or 'mp4',
+            'filesize': filesize,
+            'filesize_mb': round(filesize / (1024 * 1024), 2) if filesize > 0 else 0
+        }
+    
+    # Sort by resolution (descending)
+    return [best_by_height[height] for height in sorted(best_by_height, reverse=True)]
+
+
+@app.route('/api/qualities', methods=['POST'])
+@api_error_handler
+def get_qualities():
+    """Fetch available video qualities for a YouTube URL"""
+    data = request.get_json()
+    url = data.get('url')
+    
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    
+    url = require_youtube_url(url)
+    
+    body, etag = qualities_response(url)
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    
+    # Clients re-querying the same video can revalidate with If-None-Match instead of
+    # re-downloading the list (make_conditional() only handles GET/HEAD, so check here)
+    response.headers['Cache-Control'] = f'private, max-age={VIDEO_INFO_CACHE_TTL}'
+    # flask-compress tags compressed variants as "<etag>:br" / "<etag>:gzip"
+    client_etags = {tag.split(':')[0] for tag in request.if_none_match.as_set(include_weak=True)}
+    if request.if_none_match.star_tag or etag in client_etags:
+        return Response(status=304, headers={'ETag': response.headers['ETag'], 'Cache-Control': response.headers['Cache-Control']})
+    
+    return response
+
+
+@app.route('/api/qualities/batch', methods=['POST'])
+@api_error_handler
+def get_qualities_batch():
+    """
+    Fetch the qualities of several YouTube URLs in one request
+    
+    URLs are looked up concurrently (extractions still share the YT_CONCURRENCY slots)
+    and each gets its own result, so one failing URL doesn't fail the batch. Each
+    distinct URL costs one rate-limit token; repeated URLs are looked up once.
+    """
+    data = request.get_json()
+    urls = data.get('urls')
+    
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        return jsonify({'error': 'urls must be a non-empty list of strings'}), 400
+    unique_urls = list(dict.fromkeys(urls))
+    if len(unique_urls) > BATCH_MAX_URLS:
+        return jsonify({'error': f'At most {BATCH_MAX_URLS} URLs can be requested at once'}), 400
+    
+    retry_after = take_rate_limit_token(request.remote_addr, len(unique_urls))
+    if retry_after:
+        return rate_limited_response(retry_after)
+    
+    def lookup(url):
+        # Each result is serialized here; successful ones splice in the cached /api/qualities body as is
+        try:
+            body, _ = qualities_response(require_youtube_url(url))
+            return b'{"url":' + orjson.dumps(url) + b',"ok":true,"data":' + body.rstrip() + b'}'
+        except Exception as e:
+            return orjson.dumps({'url': url, 'ok': False, 'error': str(e), 'status': error_status_code(str(e))})
+    
+    results = dict(zip(unique_urls, _batch_executor.map(lookup, unique_urls)))
+    body = b'{"results":[' + b','.join(results[url] for url in urls) + b']}\n'
+    return app.response_class(body, mimetype='application/json')
+
+
+@app.route('/api/download', methods=['GET', 'HEAD', 'POST'])
+@api_error_handler
 def download_video():
-    """Download a YouTube video with the selected quality"""
+    """
+    Download a YouTube video with the selected quality
+    
+    The frontend POSTs JSON. GET and HEAD take the same fields as query parameters so that
+    download managers can probe the size and resume (Range) single-stream formats.
+    """
     temp_dir = None
-    output_path = None
     
     try:
-        data = request.get_json()
+        data = request.get_json() if request.method == 'POST' else request.args
         url = data.get('url')
         format_id = data.get('format_id')
         
         if not url or not format_id:
             return jsonify({'error': 'URL and format_id are required'}), 400
         
-        # Validate URL format (basic check)
-        if not url.startswith(('http://', 'https://')):
-            return jsonify({'error': 'Invalid URL format. URL must start with http:// or https://'}), 400
+        url = require_youtube_url(url)
         
-        # Create temporary directory for download
-        temp_dir = tempfile.mkdtemp()
+        # HEAD is answered from the cached metadata without opening anything upstream.
+        # A cold cache doesn't start an extraction just for a probe; the size is left out instead.
+        if request.method == 'HEAD':
+            video_info = cached_video_info(url)
+            response = Response(mimetype='application/octet-stream')
+            if video_info is not None:
+                direct_formats = find_direct_formats(video_info, format_id)
+                single_fmt = direct_formats[0] if direct_formats and len(direct_formats) == 1 else {}
+                safe_title = sanitize_filename(video_info.get('title', 'video'))
+                response.headers['Content-Disposition'] = attachment_disposition(f"{safe_title}.{single_fmt.get('ext') or 'mp4'}")
+                if single_fmt.get('filesize'):
+                    response.headers['Content-Length'] = str(single_fmt['filesize'])
+                    response.headers['Accept-Ranges'] = 'bytes'
+            if 'Accept-Ranges' not in response.headers:
+                # Size unknown: don't let the empty HEAD body claim Content-Length: 0
+                response.automatically_set_content_length = False
+                del response.headers['Content-Length']
+            return response
         
-        # Get video title first for filename
+        # Get video title first for filename (usually cached by the preceding /api/qualities call)
         video_info = get_video_info(url)
         title = video_info.get('title', 'video')
         safe_title = sanitize_filename(title)
         
-        # Download using yt-dlp with specific format
-        output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
-
-        requires_merge = '+' in format_id
-        ffmpeg_path = tool_exists('ffmpeg')
-        has_ffmpeg = ffmpeg_path is not None
-        
-        # Build yt-dlp command with enhanced headers for Render
-        yt_cmd = [
-            'python', '-m', 'yt_dlp',
-            '-f', format_id,
-            '-o', output_template,
-            '--no-warnings',
-            '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            '--add-header', 'Accept:text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            '--add-header', 'Accept-Language:en-US,en;q=0.9',
-            '--add-header', 'Accept-Encoding:gzip, deflate, br',
-            '--add-header', 'DNT:1',
-            '--add-header', 'Connection:keep-alive',
-            '--add-header', 'Upgrade-Insecure-Requests:1'
-        ]
+        # Direct-URL formats are streamed straight to the client, skipping the temp dir.
+        # Single progressive streams are proxied as-is.
+        direct_formats = find_direct_formats(video_info, format_id)
+        single_fmt = direct_formats[0] if direct_formats and len(direct_formats) == 1 else None
+        filesize = single_fmt.get('filesize') if single_fmt else None
         
-        # Try to find Node.js for JavaScript runtime
-        node_paths = ['node', '/usr/bin/node', '/usr/local/bin/node']
-        for node_path in node_paths:
+        body = None
+        status_code = 200
+        content_range = None
+        if single_fmt:
+            start, end = 0, None
+            content_length = filesize
+            # A single byte range (resume, segmented download) maps straight onto the upstream
+            # range requests. Without validators to check If-Range against, send the whole file.
+            if filesize and request.range and len(request.range.ranges) == 1 and 'If-Range' not in request.headers:
+                byte_range = request.range.range_for_length(filesize)
+                if byte_range is None:
+                    return Response(status=416, headers={'Content-Range': f'bytes */{filesize}'})
+                start, stop = byte_range
+                end = stop - 1
+                content_length = stop - start
+                content_range = f'bytes {start}-{end}/{filesize}'
+                status_code = 206
             try:
-                result = subprocess.run([node_path, '--version'], capture_output=True, text=True, timeout=5)
-                if result.returncode == 0:
-                    yt_cmd.extend(['--js-runtimes', node_path])
-                    break
-            except:
-                continue
-        
-        # Prepare environment with ffmpeg path if available
-        env = os.environ.copy()
-        if has_ffmpeg and os.name == 'nt':
-            # Add ffmpeg bin directory to PATH for Windows
-            ffmpeg_bin_dir = os.path.dirname(ffmpeg_path)
-            if ffmpeg_bin_dir:
-                env['PATH'] = ffmpeg_bin_dir + ';' + env.get('PATH', '')
-        
-        if requires_merge:
-            if has_ffmpeg:
-                # Ensure audio and video are merged into mp4 with ffmpeg
-                yt_cmd.extend([
-                    '--merge-output-format', 'mp4',
-                    '--postprocessor-args', 'ffmpeg:-c copy',
-                    '--no-keep-video'  # Don't keep separate video/audio files
-                ])
-            else:
-                # Use yt-dlp's built-in merger without explicit ffmpeg
-                yt_cmd.extend([
-                    '--merge-output-format', 'mkv',  # Use mkv as fallback if no ffmpeg
-                ])
-        
-        yt_cmd.append(url)
+                body = hold_download_slot(stream_format, single_fmt, start, end)
+            except requests.RequestException as e:
+                print(f"Direct stream failed, falling back to yt-dlp download: {e}")
+            filename = f"{safe_title}.{single_fmt.get('ext') or 'mp4'}"
+        else:
+            # Video+audio pairs and HLS formats are remuxed by ffmpeg on the fly
+            remux_formats = find_direct_formats(video_info, format_id, DIRECT_PROTOCOLS + FFMPEG_STREAM_PROTOCOLS)
+            if can_remux_formats(remux_formats):
+                try:
+                    body = hold_download_slot(stream_remuxed_formats, remux_formats)
+                except (requests.RequestException, OSError) as e:
+                    print(f"Remuxed stream failed, falling back to yt-dlp download: {e}")
+                # The remuxed size is not known up front
+                filename = f"{safe_title}.mp4"
+                content_length = None
         
-        print(f"Executing command: {' '.join(yt_cmd)}")  # Debug logging
-        print(f"FFmpeg available: {has_ffmpeg}, path: {ffmpeg_path}")  # Debug logging
+        if body is not None:
+            response = Response(body, status=status_code, mimetype='application/octet-stream')
+            response.headers['Content-Disposition'] = attachment_disposition(filename)
+            if content_length:
+                response.headers['Content-Length'] = str(content_length)
+            if filesize:
+                response.headers['Accept-Ranges'] = 'bytes'
+            if content_range:
+                response.headers['Content-Range'] = content_range
+            response.headers['X-Content-Type-Options'] = 'nosniff'
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
         
-        result = subprocess.run(
-            yt_cmd,
-            capture_output=True,
-            text=True,
-            timeout=300,  # 5 minutes timeout for download
-            env=env  # Pass environment with ffmpeg PATH
-        )
-        
-        print(f"yt-dlp stdout: {result.stdout}")  # Debug logging
-        print(f"yt-dlp stderr: {result.stderr}")  # Debug logging
-        
-        if result.returncode != 0:
-            error_msg = result.stderr.strip()
-            print(f"yt-dlp error (return code {result.returncode}): {error_msg}")
-            raise Exception(f'Download failed: {error_msg}')
-        
-        # Find the downloaded file
-        files = os.listdir(temp_dir)
-        print(f"Files in temp dir: {files}")  # Debug logging
-        if not files:
-            raise Exception('Download completed but file not found')
-        
-        output_path = os.path.join(temp_dir, files[0])
-        print(f"Downloaded file: {output_path}")  # Debug logging
-        
-        # Get file extension
-        _, ext = os.path.splitext(output_path)
-        if not ext:
-            ext = '.mp4'
-        
-        # Get file size for Content-Length header
-        file_size = os.path.getsize(output_path)
-        
-        # Create streaming response with proper headers for progress tracking
-        def generate():
-            chunk_size = 64 * 1024  # 64KB chunks for smoother progress updates
-            with open(output_path, 'rb') as f:
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    yield chunk
-            # Cleanup after streaming
-            try:
-                if temp_dir and os.path.exists(temp_dir):
-                    import time
-                    time.sleep(0.1)
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-            except Exception:
-                pass
-        
-        from flask import Response
-        response = Response(generate(), mimetype='application/octet-stream', direct_passthrough=False)
-        response.headers['Content-Disposition'] = f'attachment; filename="{safe_title}{ext}"'
-        response.headers['Content-Length'] = str(file_size)
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        response.headers['Cache-Control'] = 'no-cache'
-        response.headers['X-Accel-Buffering'] = 'no'
+        # Create temporary directory for download
+        temp_dir = tempfile.mkdtemp(prefix=TEMP_DIR_PREFIX, dir=DOWNLOAD_TMP_ROOT)
+        output_path = download_to_dir(video_info, format_id, temp_dir)
+        response = send_downloaded_file(output_path, temp_dir, safe_title)
         
         return response
     
-    except subprocess.TimeoutExpired:
-        cleanup_temp_files(output_path, temp_dir)
-        return jsonify({'error': 'Download timed out. The video may be too large or your connection is slow.'}), 408
+    except Exception:
+        cleanup_temp_files(temp_dir)
+        raise
+
+
+def job_dir(job_id):
+    """Return the staging dir of a background job (its state file and download live there)"""
+    return os.path.join(DOWNLOAD_TMP_ROOT, f'{TEMP_DIR_PREFIX}job-{job_id}')
+
+
+def save_job(job_id, job):
+    """Write a job's state file; the rename makes the update atomic for readers in other workers"""
+    path = os.path.join(job_dir(job_id), JOB_STATE_FILE)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    with open(temp_path, 'wb') as f:
+        f.write(orjson.dumps(job))
+    os.replace(temp_path, path)
+
+
+def load_job(job_id):
+    """Read a job's state file, or return None if there is no such job (or it was already fetched)"""
+    if not JOB_ID_RE.match(job_id):
+        return None
+    try:
+        with open(os.path.join(job_dir(job_id), JOB_STATE_FILE), 'rb') as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def run_download_job(job_id, job, url, format_id):
+    """Extract and download a video for a background job, recording progress in its state file"""
+    download_dir = os.path.join(job_dir(job_id), 'download')
+    job['status'] = 'running'
+    save_job(job_id, job)
+    last_saved = time.monotonic()
+    
+    def progress_hook(d):
+        nonlocal last_saved
+        # Merged formats download one file per stream, so progress is tracked per file
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        job['files'][d.get('filename') or ''] = (d.get('downloaded_bytes') or 0, total)
+        now = time.monotonic()
+        if now - last_saved >= JOB_PROGRESS_SAVE_INTERVAL:
+            last_saved = now
+            save_job(job_id, job)
     
+    try:
+        video_info = get_video_info(url)
+        job['title'] = sanitize_filename(video_info.get('title', 'video'))
+        os.mkdir(download_dir)
+        job['output_path'] = download_to_dir(video_info, format_id, download_dir, progress_hook)
+        job['status'] = 'finished'
     except Exception as e:
-        cleanup_temp_files(output_path, temp_dir)
-        error_message = str(e)
-        status_code = 400
-        
-        if 'unavailable' in error_message.lower() or 'removed' in error_message.lower():
-            status_code = 404
-        elif 'private' in error_message.lower() or 'region' in error_message.lower() or 'age-restricted' in error_message.lower() or 'members' in error_message.lower():
-            status_code = 403
-        elif 'timeout' in error_message.lower() or 'network' in error_message.lower():
-            status_code = 503
-        
-        return jsonify({'error': error_message}), status_code
+        # Drop the partial download now; the state file stays until the job expires
+        schedule_cleanup(download_dir)
+        job['error'] = str(e)
+        job['status'] = 'error'
+    finally:
+        job['finished_at'] = time.time()
+        save_job(job_id, job)
 
 
-def cleanup_temp_files(output_path, temp_dir):
-    """Helper function to clean up temporary files"""
+def expire_jobs():
+    """Remove finished jobs whose file was never fetched, along with their staging dirs"""
+    cutoff = time.time() - DOWNLOAD_JOB_TTL
+    prefix = f'{TEMP_DIR_PREFIX}job-'
+    try:
+        with os.scandir(DOWNLOAD_TMP_ROOT) as entries:
+            job_ids = [entry.name[len(prefix):] for entry in entries if entry.name.startswith(prefix)]
+    except OSError as e:
+        print(f"Could not list jobs in {DOWNLOAD_TMP_ROOT}: {e}")
+        return
+    for job_id in job_ids:
+        job = load_job(job_id)
+        if job and (job.get('finished_at') or cutoff) < cutoff:
+            schedule_cleanup(job_dir(job_id))
+
+
+@app.route('/api/jobs', methods=['POST'])
+@api_error_handler
+def create_download_job():
+    """Start a download in the background and return its job id immediately"""
+    data = request.get_json()
+    url = data.get('url')
+    format_id = data.get('format_id')
+    
+    if not url or not format_id:
+        return jsonify({'error': 'URL and format_id are required'}), 400
+    
+    url = require_youtube_url(url)
+    
+    expire_jobs()
+    
+    job_id = uuid.uuid4().hex
+    job = {
+        'status': 'queued',
+        'title': None,
+        'files': {},
+        'error': None,
+        'output_path': None,
+        'finished_at': None,
+    }
+    os.mkdir(job_dir(job_id))
+    save_job(job_id, job)
+    _download_executor.submit(run_download_job, job_id, job, url, format_id)
+    
+    return jsonify({'job_id': job_id}), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_download_job(job_id):
+    """Report the status and progress of a background download"""
+    job = load_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    progress = list(job['files'].values())
+    downloaded_bytes = sum(done for done, _ in progress)
+    total_bytes = sum(total for _, total in progress)
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'title': job['title'],
+        'downloaded_bytes': downloaded_bytes,
+        'total_bytes': total_bytes,
+        'progress': 100 if job['status'] == 'finished' else round(downloaded_bytes * 100 / total_bytes, 1) if total_bytes else 0,
+        'error': job['error']
+    })
+
+
+@app.route('/api/jobs/<job_id>/file', methods=['GET'])
+@api_error_handler
+def get_download_job_file(job_id):
+    """Send the file of a finished background download (once; the job is removed afterwards)"""
+    job = load_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] != 'finished':
+        return jsonify({'error': f"Job is {job['status']}", 'status': job['status']}), 409
+    
+    # Claim the job by renaming its state file; only one request (in any worker) can win
+    state_path = os.path.join(job_dir(job_id), JOB_STATE_FILE)
     try:
-        if temp_dir and os.path.exists(temp_dir):
-            # Use ignore_errors for more robust cleanup
-            shutil.rmtree(temp_dir, ignore_errors=True)
-    except (OSError, IOError):
-        # Ignore errors during cleanup
-        pass
+        os.rename(state_path, f'{state_path}.fetched')
+    except FileNotFoundError:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return send_downloaded_file(job['output_path'], job_dir(job_id), job['title'])
+
+
+def cleanup_temp_files(temp_dir):
+    """Helper function to clean up temporary files"""
+    # Removed by the background cleanup thread so the error response isn't delayed;
+    # rmtree(ignore_errors=True) copes with a missing dir, so there's no exists() check
+    if temp_dir:
+        schedule_cleanup(temp_dir)
 
 if __name__ == '__main__':
     # Use environment variable for port (required for Render)
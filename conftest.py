@@ -0,0 +1,72 @@
+"""Shared pytest fixtures for the app's unit tests (no network access needed)"""
+import os
+import tempfile
+import types
+
+# Stage downloads and job state in a private dir instead of /dev/shm; must be set before app is imported
+os.environ['DOWNLOAD_TMP_DIR'] = tempfile.mkdtemp(prefix='ytdl-tests-')
+
+import pytest
+
+import app as app_module
+
+
+VIDEO_ID = 'jNQXAC9IVRw'
+VIDEO_URL = f'https://www.youtube.com/watch?v={VIDEO_ID}'
+
+
+def make_video_info(title='Me at the zoo'):
+    """Return a minimal yt-dlp info dict with a progressive, a video-only and an audio-only format"""
+    return {
+        'id': VIDEO_ID,
+        'title': title,
+        'thumbnail': 'https://i.ytimg.com/vi/jNQXAC9IVRw/hqdefault.jpg',
+        'webpage_url': VIDEO_URL,
+        'formats': [
+            {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'ext': 'm4a', 'abr': 128,
+             'filesize': 300000, 'url': 'https://cdn.example/140', 'protocol': 'https'},
+            {'format_id': '18', 'vcodec': 'avc1', 'acodec': 'mp4a', 'ext': 'mp4', 'height': 360,
+             'filesize': 256000, 'url': 'https://cdn.example/18', 'protocol': 'https',
+             'downloader_options': {'http_chunk_size': 64000}},
+            {'format_id': '137', 'vcodec': 'avc1', 'acodec': 'none', 'ext': 'mp4', 'height': 1080,
+             'filesize': 1000000, 'url': 'https://cdn.example/137', 'protocol': 'https'},
+        ],
+    }
+
+
+class FakeClock:
+    """Replaces the time module in app so TTLs and token refills can be stepped through"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app_module, 'time', types.SimpleNamespace(monotonic=clock.monotonic, time=clock.monotonic))
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    """Give every test empty caches and rate-limit buckets"""
+    monkeypatch.setattr(app_module, '_video_info_cache', app_module.TTLCache(app_module.VIDEO_INFO_CACHE_MAXSIZE))
+    monkeypatch.setattr(app_module, '_qualities_response_cache', app_module.TTLCache(app_module.VIDEO_INFO_CACHE_MAXSIZE))
+    monkeypatch.setattr(app_module, '_rate_buckets', {})
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def video_info():
+    return make_video_info()
@@ -0,0 +1,20 @@
+# Gunicorn settings, picked up automatically from the working directory.
+# Every value can be overridden with an environment variable on the host.
+import os
+
+# Downloads spend almost all of their time waiting on YouTube, so each process
+# serves many requests from threads rather than forking more processes
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+# The app's YouTube concurrency (YT_CONCURRENCY, DOWNLOAD_CONCURRENCY) and per-IP rate limits are kept per
+# worker process, so the server-wide limits are `workers` times the configured values
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+# Large downloads keep a request open for minutes; don't let a blocked worker be killed mid-transfer
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+graceful_timeout = 30
+keepalive = 5
+
+# Import the app (yt-dlp, its YouTube extractor, tool detection) once in the master;
+# workers are forked with it already loaded and share those pages copy-on-write
+preload_app = True
@@ -0,0 +1,155 @@
+"""Tests for the video info cache and get_video_info()"""
+import threading
+import time
+import types
+
+import pytest
+
+import app as app_module
+
+VIDEO_ID = 'jNQXAC9IVRw'
+
+
+@pytest.fixture
+def extractions(monkeypatch):
+    """Count extract_video_info calls; set .result to the info dict or exception to return"""
+    calls = types.SimpleNamespace(count=0, result={'id': VIDEO_ID, 'title': 'Me at the zoo', 'formats': []})
+
+    def extract(url):
+        calls.count += 1
+        if isinstance(calls.result, Exception):
+            raise calls.result
+        return calls.result
+
+    monkeypatch.setattr(app_module, 'extract_video_info', extract)
+    return calls
+
+
+# TTLCache
+
+def test_ttl_cache_entries_expire(clock):
+    cache = app_module.TTLCache(4)
+    cache.set('a', 1, ttl=10)
+    clock.advance(9.9)
+    assert cache.get('a') == 1
+    clock.advance(0.1)
+    assert cache.get('a') is None
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = app_module.TTLCache(2)
+    cache.set('a', 1, ttl=60)
+    cache.set('b', 2, ttl=60)
+    assert cache.get('a') == 1  # 'b' is now the least recently used
+    cache.set('c', 3, ttl=60)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+# get_video_info
+
+def test_video_info_is_cached_per_video_id(extractions, clock):
+    first = app_module.get_video_info(f'https://www.youtube.com/watch?v={VIDEO_ID}')
+    second = app_module.get_video_info(f'https://youtu.be/{VIDEO_ID}')
+    assert first is second
+    assert extractions.count == 1
+    clock.advance(app_module.VIDEO_INFO_CACHE_TTL)
+    app_module.get_video_info(f'https://youtu.be/{VIDEO_ID}')
+    assert extractions.count == 2
+
+
+def test_failed_extraction_is_cached_for_error_ttl(extractions, clock):
+    extractions.result = Exception('Video is unavailable. It may have been removed or made private.')
+    url = f'https://www.youtube.com/watch?v={VIDEO_ID}'
+    for _ in range(2):
+        with pytest.raises(Exception, match='Video is unavailable'):
+            app_module.get_video_info(url)
+    assert extractions.count == 1
+
+    clock.advance(app_module.VIDEO_INFO_ERROR_TTL)
+    with pytest.raises(Exception, match='Video is unavailable'):
+        app_module.get_video_info(url)
+    assert extractions.count == 2
+
+
+@pytest.mark.parametrize('error', [
+    Exception('Request timed out. Please try again.'),
+    Exception('Network error. Please check your connection and try again.'),
+    app_module.ServerBusyError('The server is busy right now. Please try again in a few seconds.'),
+])
+def test_transient_errors_are_not_cached(extractions, clock, error):
+    extractions.result = error
+    url = f'https://www.youtube.com/watch?v={VIDEO_ID}'
+    for _ in range(2):
+        with pytest.raises(Exception):
+            app_module.get_video_info(url)
+    assert extractions.count == 2
+
+
+# In-flight coalescing
+
+def test_concurrent_misses_share_one_extraction(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_extract(url):
+        calls.append(url)
+        started.set()
+        release.wait(5)
+        return {'id': VIDEO_ID, 'title': 'Me at the zoo', 'formats': []}
+
+    monkeypatch.setattr(app_module, 'extract_video_info', slow_extract)
+    results = []
+
+    def fetch(url):
+        results.append(app_module.get_video_info(url))
+
+    owner = threading.Thread(target=fetch, args=(f'https://www.youtube.com/watch?v={VIDEO_ID}',))
+    owner.start()
+    assert started.wait(5)
+    waiters = [threading.Thread(target=fetch, args=(f'https://youtu.be/{VIDEO_ID}',)) for _ in range(3)]
+    for thread in waiters:
+        thread.start()
+    # Give the waiters time to reach the in-flight Future before the extraction finishes
+    time.sleep(0.1)
+    release.set()
+    for thread in [owner] + waiters:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert len(results) == 4
+    assert all(result is results[0] for result in results)
+    assert app_module._inflight_extractions == {}
+
+
+def test_concurrent_misses_share_the_failure(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing_extract(url):
+        started.set()
+        release.wait(5)
+        raise Exception('This video is private.')
+
+    monkeypatch.setattr(app_module, 'extract_video_info', failing_extract)
+    errors = []
+
+    def fetch():
+        try:
+            app_module.get_video_info(f'https://www.youtube.com/watch?v={VIDEO_ID}')
+        except Exception as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=fetch) for _ in range(3)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert errors == ['This video is private.'] * 3
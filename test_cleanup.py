@@ -0,0 +1,25 @@
+"""Tests for the background temp dir cleanup thread"""
+import queue
+import threading
+import time
+
+import app as app_module
+
+
+def test_stale_dirs_are_swept_while_the_queue_is_busy(monkeypatch, tmp_path):
+    cleanup_queue = queue.SimpleQueue()
+    sweeps = threading.Event()
+    monkeypatch.setattr(app_module, '_cleanup_queue', cleanup_queue)
+    monkeypatch.setattr(app_module, 'TEMP_SWEEP_INTERVAL', 0.1)
+    monkeypatch.setattr(app_module, 'sweep_stale_temp_dirs', sweeps.set)
+    threading.Thread(target=app_module._cleanup_worker, daemon=True).start()
+
+    # A new dir to remove arrives well within every sweep interval
+    deadline = time.monotonic() + 2
+    while not sweeps.is_set() and time.monotonic() < deadline:
+        staged = tmp_path / f'ytdl-{time.monotonic_ns()}'
+        staged.mkdir()
+        cleanup_queue.put(str(staged))
+        time.sleep(0.01)
+
+    assert sweeps.is_set()
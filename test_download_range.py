@@ -0,0 +1,179 @@
+"""Tests for proxied single-stream downloads (/api/download): Range handling and download slots"""
+import re
+import threading
+
+import pytest
+
+import app as app_module
+
+VIDEO_URL = 'https://www.youtube.com/watch?v=jNQXAC9IVRw'
+FILESIZE = 256000
+CONTENT = bytes(range(256)) * (FILESIZE // 256)
+
+
+class FakeUpstream:
+    """Stand-in for a streamed requests.Response serving a byte range of CONTENT"""
+
+    def __init__(self, range_header):
+        start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header).groups()
+        start = int(start)
+        end = min(int(end), FILESIZE - 1) if end else FILESIZE - 1
+        self.status_code = 416 if start >= FILESIZE else 206
+        self.content = CONTENT[start:end + 1]
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@pytest.fixture
+def upstream_ranges(monkeypatch, video_info):
+    """Serve format 18 from FakeUpstream and record the Range header of every upstream request"""
+    ranges = []
+
+    def fake_get(url, headers=None, **kwargs):
+        assert url == 'https://cdn.example/18'
+        ranges.append(headers['Range'])
+        return FakeUpstream(headers['Range'])
+
+    monkeypatch.setattr(app_module.HTTP_SESSION, 'get', fake_get)
+    monkeypatch.setattr(app_module, 'get_video_info', lambda url: video_info)
+    return ranges
+
+
+def download(client, headers=None, method='GET'):
+    return client.open('/api/download', method=method, headers=headers,
+                       query_string={'url': VIDEO_URL, 'format_id': '18'})
+
+
+def test_full_download_is_fetched_in_http_chunk_size_ranges(client, upstream_ranges):
+    with download(client) as response:
+        assert response.status_code == 200
+        assert response.headers['Content-Length'] == str(FILESIZE)
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.get_data() == CONTENT
+    assert upstream_ranges == ['bytes=0-63999', 'bytes=64000-127999', 'bytes=128000-191999', 'bytes=192000-255999']
+
+
+@pytest.mark.parametrize('range_header, start, end, expected_upstream', [
+    ('bytes=0-99', 0, 99, ['bytes=0-99']),
+    ('bytes=-10', 255990, 255999, ['bytes=255990-255999']),
+    ('bytes=63990-64010', 63990, 64010, ['bytes=63990-64010']),
+    ('bytes=1000-200000', 1000, 200000,
+     ['bytes=1000-64999', 'bytes=65000-128999', 'bytes=129000-192999', 'bytes=193000-200000']),
+    ('bytes=250000-', 250000, 255999, ['bytes=250000-255999']),
+])
+def test_single_range_maps_onto_upstream_ranges(client, upstream_ranges, range_header, start, end, expected_upstream):
+    with download(client, {'Range': range_header}) as response:
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == f'bytes {start}-{end}/{FILESIZE}'
+        assert response.headers['Content-Length'] == str(end - start + 1)
+        assert response.get_data() == CONTENT[start:end + 1]
+    assert upstream_ranges == expected_upstream
+
+
+def test_unsatisfiable_range_is_416(client, upstream_ranges):
+    response = download(client, {'Range': f'bytes={FILESIZE}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{FILESIZE}'
+    assert upstream_ranges == []
+
+
+@pytest.mark.parametrize('headers', [
+    {'Range': 'bytes=0-99', 'If-Range': '"some-etag"'},
+    {'Range': 'bytes=0-99,200-299'},
+])
+def test_if_range_and_multiple_ranges_fall_back_to_full_file(client, upstream_ranges, headers):
+    with download(client, headers) as response:
+        assert response.status_code == 200
+        assert 'Content-Range' not in response.headers
+        assert response.headers['Content-Length'] == str(FILESIZE)
+        assert response.get_data() == CONTENT
+
+
+def test_head_reports_size_from_cache(client, upstream_ranges, video_info):
+    app_module._video_info_cache.set('jNQXAC9IVRw', video_info, 60)
+    response = download(client, method='HEAD')
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(FILESIZE)
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'Me at the zoo.mp4' in response.headers['Content-Disposition']
+    assert upstream_ranges == []
+
+
+def test_head_does_not_extract_on_cold_cache(client, monkeypatch):
+    def extract(url):
+        raise AssertionError('HEAD must not run an extraction')
+    monkeypatch.setattr(app_module, 'get_video_info', extract)
+    monkeypatch.setattr(app_module, 'extract_video_info', extract)
+
+    response = download(client, method='HEAD')
+    assert response.status_code == 200
+    assert 'Content-Length' not in response.headers
+    assert 'Accept-Ranges' not in response.headers
+
+
+def test_downloads_hold_their_own_slots(client, upstream_ranges, monkeypatch):
+    monkeypatch.setattr(app_module, '_download_semaphore', threading.BoundedSemaphore(1))
+    monkeypatch.setattr(app_module, 'YT_QUEUE_TIMEOUT', 0.05)
+
+    with download(client) as response:
+        assert response.status_code == 200
+        # The only download slot is held until the response is closed...
+        busy = download(client)
+        assert busy.status_code == 503
+        assert 'Retry-After' in busy.headers
+        # ...while extractions still have theirs
+        with app_module.youtube_slot():
+            pass
+    with download(client) as response:
+        assert response.status_code == 200
+
+
+@pytest.fixture
+def staged_download(monkeypatch, video_info):
+    """Stage format 137+140 (no ffmpeg, so it can't be remuxed) from a fake yt-dlp download"""
+    def fake_download_to_dir(video_info, format_id, temp_dir, progress_hook=None):
+        path = f'{temp_dir}/staged.mkv'
+        with open(path, 'wb') as f:
+            f.write(CONTENT[:1000])
+        return path
+
+    monkeypatch.setattr(app_module, 'FFMPEG_PATH', None)
+    monkeypatch.setattr(app_module, 'get_video_info', lambda url: video_info)
+    monkeypatch.setattr(app_module, 'download_to_dir', fake_download_to_dir)
+
+
+def download_staged(client, headers=None):
+    return client.get('/api/download', headers=headers,
+                      query_string={'url': VIDEO_URL, 'format_id': '137+140'})
+
+
+def test_staged_download_honours_range(client, staged_download):
+    with download_staged(client, {'Range': 'bytes=0-9'}) as response:
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == 'bytes 0-9/1000'
+        assert response.headers['Content-Length'] == '10'
+        assert response.get_data() == CONTENT[:10]
+
+    with download_staged(client, {'Range': 'bytes=2000-'}) as response:
+        assert response.status_code == 416
+
+    with download_staged(client) as response:
+        assert response.status_code == 200
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.headers['Content-Length'] == '1000'
+        assert response.get_data() == CONTENT[:1000]
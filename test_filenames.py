@@ -0,0 +1,17 @@
+"""Tests for download filename handling"""
+import pytest
+
+import app as app_module
+
+
+@pytest.mark.parametrize('title, expected', [
+    ('Me at the zoo', 'Me at the zoo'),
+    ('AC/DC: Back in Black?', 'ACDC Back in Black'),
+    ('<b>"quoted"</b> | a*b\\c', 'bquotedb  abc'),
+    ('../../etc/passwd', 'etcpasswd'),
+    ('  ...  ', 'video'),
+    ('', 'video'),
+    ('x' * 300, 'x' * 200),
+])
+def test_sanitize_filename(title, expected):
+    assert app_module.sanitize_filename(title) == expected
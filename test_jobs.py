@@ -0,0 +1,100 @@
+"""Tests for the background download jobs API (/api/jobs)"""
+import os
+import time
+
+import app as app_module
+
+VIDEO_URL = 'https://www.youtube.com/watch?v=jNQXAC9IVRw'
+
+
+def fake_download_to_dir(video_info, format_id, temp_dir, progress_hook=None):
+    path = os.path.join(temp_dir, f"{video_info['title']}.mp4")
+    with open(path, 'wb') as f:
+        f.write(b'video bytes')
+    if progress_hook:
+        progress_hook({'filename': path, 'downloaded_bytes': 11, 'total_bytes': 11})
+    return path
+
+
+def wait_for_job(client, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(f'/api/jobs/{job_id}')
+        assert response.status_code == 200
+        job = response.get_json()
+        if job['status'] in ('finished', 'error') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.02)
+
+
+def test_job_is_created_polled_and_fetched_once(client, monkeypatch, video_info):
+    monkeypatch.setattr(app_module, 'get_video_info', lambda url: video_info)
+    monkeypatch.setattr(app_module, 'download_to_dir', fake_download_to_dir)
+
+    response = client.post('/api/jobs', json={'url': VIDEO_URL, 'format_id': '18'})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+
+    job = wait_for_job(client, job_id)
+    assert job['status'] == 'finished'
+    assert job['title'] == 'Me at the zoo'
+    assert job['progress'] == 100
+
+    with client.get(f'/api/jobs/{job_id}/file') as response:
+        assert response.status_code == 200
+        assert response.get_data() == b'video bytes'
+        assert 'Me at the zoo.mp4' in response.headers['Content-Disposition']
+
+    # The file can be fetched once, then the job is gone
+    assert client.get(f'/api/jobs/{job_id}/file').status_code == 404
+    assert client.get(f'/api/jobs/{job_id}').status_code == 404
+
+
+def test_job_state_is_readable_from_any_worker(client):
+    # Another worker process only shares the staging dir, so a state file written there must be enough
+    job_id = 'a' * 32
+    os.mkdir(app_module.job_dir(job_id))
+    app_module.save_job(job_id, {
+        'status': 'running',
+        'title': 'Me at the zoo',
+        'files': {'video.mp4': [25, 100]},
+        'error': None,
+        'output_path': None,
+        'finished_at': None,
+    })
+
+    job = client.get(f'/api/jobs/{job_id}').get_json()
+    assert job['status'] == 'running'
+    assert job['progress'] == 25
+    assert client.get(f'/api/jobs/{job_id}/file').status_code == 409
+
+
+def test_failed_job_reports_error(client, monkeypatch):
+    def fail(url):
+        raise Exception('Video is unavailable. It may have been removed or made private.')
+    monkeypatch.setattr(app_module, 'get_video_info', fail)
+
+    job_id = client.post('/api/jobs', json={'url': VIDEO_URL, 'format_id': '18'}).get_json()['job_id']
+
+    job = wait_for_job(client, job_id)
+    assert job['status'] == 'error'
+    assert job['error'].startswith('Video is unavailable')
+
+
+def test_unknown_and_malformed_job_ids_are_not_found(client):
+    assert client.get('/api/jobs/' + 'b' * 32).status_code == 404
+    assert client.get('/api/jobs/..').status_code == 404
+    assert client.get('/api/jobs/not-a-job/file').status_code == 404
+
+
+def test_expired_jobs_are_removed(monkeypatch):
+    removed = []
+    monkeypatch.setattr(app_module, 'schedule_cleanup', removed.append)
+    job_id = 'c' * 32
+    os.mkdir(app_module.job_dir(job_id))
+    app_module.save_job(job_id, {'status': 'finished', 'title': 'x', 'files': {}, 'error': None,
+                                 'output_path': None, 'finished_at': time.time() - app_module.DOWNLOAD_JOB_TTL - 1})
+
+    app_module.expire_jobs()
+
+    assert removed == [app_module.job_dir(job_id)]
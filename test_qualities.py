@@ -0,0 +1,198 @@
+"""Tests for the /api/qualities format list and the batch endpoint"""
+import orjson
+import pytest
+
+import app as app_module
+
+VIDEO_ID = 'jNQXAC9IVRw'
+
+
+def audio(format_id, ext, abr, filesize):
+    return {'format_id': format_id, 'vcodec': 'none', 'acodec': 'opus' if ext == 'webm' else 'mp4a.40.2',
+            'ext': ext, 'abr': abr, 'filesize': filesize}
+
+
+def video(format_id, ext, height, filesize, acodec='none'):
+    return {'format_id': format_id, 'vcodec': 'vp9' if ext == 'webm' else 'avc1', 'acodec': acodec,
+            'ext': ext, 'height': height, 'filesize': filesize}
+
+
+def test_one_option_per_height_keeping_the_largest():
+    qualities = app_module.list_qualities([
+        video('18', 'mp4', 360, 5000, acodec='mp4a'),
+        video('243', 'webm', 360, 9000, acodec='opus'),
+        video('134', 'mp4', 360, 7000, acodec='mp4a'),
+    ])
+    assert qualities == [
+        {'format_id': '243', 'resolution': '360p', 'ext': 'webm', 'filesize': 9000, 'filesize_mb': 0.01},
+    ]
+
+
+def test_video_only_formats_are_paired_with_same_container_audio():
+    qualities = app_module.list_qualities([
+        audio('251', 'webm', 160, 3000),
+        audio('250', 'webm', 70, 1000),
+        audio('mp4-audio', 'mp4', 64, 2000),
+        video('137', 'mp4', 1080, 10 * 1024 * 1024),
+        video('248', 'webm', 1440, 20 * 1024 * 1024),
+    ])
+    by_resolution = {quality['resolution']: quality for quality in qualities}
+    # Same container first, best bitrate within it...
+    assert by_resolution['1440p']['format_id'] == '248+251'
+    assert by_resolution['1440p']['filesize'] == 20 * 1024 * 1024 + 3000
+    # ...even over a better audio in another container
+    assert by_resolution['1080p']['format_id'] == '137+mp4-audio'
+    assert by_resolution['1080p']['filesize_mb'] == 10.0
+
+
+def test_video_only_formats_fall_back_to_the_best_audio_overall():
+    qualities = app_module.list_qualities([
+        audio('140', 'm4a', 128, 3000),
+        audio('139', 'm4a', 48, 1000),
+        video('137', 'mp4', 1080, 10000),
+    ])
+    assert [quality['format_id'] for quality in qualities] == ['137+140']
+
+
+def test_video_only_formats_without_any_audio_are_skipped():
+    assert app_module.list_qualities([video('137', 'mp4', 1080, 10000)]) == []
+
+
+def test_formats_without_height_are_skipped():
+    qualities = app_module.list_qualities([
+        video('sb0', 'mhtml', None, 0, acodec='none'),
+        video('hls-unknown', 'mp4', 0, 5000, acodec='mp4a'),
+        {'format_id': 'no-height', 'vcodec': 'avc1', 'acodec': 'mp4a', 'ext': 'mp4', 'filesize': 5000},
+        video('18', 'mp4', 360, 5000, acodec='mp4a'),
+    ])
+    assert [quality['format_id'] for quality in qualities] == ['18']
+
+
+def test_qualities_are_sorted_highest_first():
+    qualities = app_module.list_qualities([
+        audio('140', 'm4a', 128, 3000),
+        video('18', 'mp4', 360, 5000, acodec='mp4a'),
+        video('137', 'mp4', 1080, 10000),
+        video('22', 'mp4', 720, 8000, acodec='mp4a'),
+        video('313', 'webm', 2160, 40000),
+        video('160', 'mp4', 144, 1000),
+    ])
+    assert [quality['resolution'] for quality in qualities] == ['2160p', '1080p', '720p', '360p', '144p']
+
+
+def test_missing_filesizes_use_the_approximation():
+    qualities = app_module.list_qualities([
+        {'format_id': '140', 'vcodec': 'none', 'acodec': 'mp4a.40.2', 'ext': 'm4a', 'abr': 128, 'filesize_approx': 1000},
+        {'format_id': '137', 'vcodec': 'avc1', 'acodec': 'none', 'ext': 'mp4', 'height': 1080, 'filesize': None,
+         'filesize_approx': 4000},
+        video('18', 'mp4', 360, None, acodec='mp4a'),
+    ])
+    assert [(quality['format_id'], quality['filesize'], quality['filesize_mb']) for quality in qualities] == [
+        ('137+140', 5000, 0.0), ('18', 0, 0),
+    ]
+
+
+# /api/qualities conditional requests
+
+@pytest.mark.parametrize('encoding, suffix', [(None, ''), ('gzip', ':gzip'), ('br', ':br')])
+def test_qualities_revalidate_with_etag(client, monkeypatch, video_info, encoding, suffix):
+    monkeypatch.setattr(app_module, 'get_video_info', lambda url: video_info)
+    # Compress even the small test payload
+    monkeypatch.setitem(app_module.app.config, 'COMPRESS_MIN_SIZE', 0)
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    url = f'https://www.youtube.com/watch?v={VIDEO_ID}'
+
+    response = client.post('/api/qualities', json={'url': url}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == encoding
+    etag = response.headers['ETag']
+    assert etag.endswith(f'{suffix}"')
+
+    # flask-compress's "<etag>:br" / "<etag>:gzip" variants match the plain ETag
+    revalidated = client.post('/api/qualities', json={'url': url}, headers={**headers, 'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.get_data() == b''
+    assert revalidated.headers['Cache-Control'] == f'private, max-age={app_module.VIDEO_INFO_CACHE_TTL}'
+
+    assert client.post('/api/qualities', json={'url': url}, headers={**headers, 'If-None-Match': '*'}).status_code == 304
+    stale = client.post('/api/qualities', json={'url': url}, headers={**headers, 'If-None-Match': '"stale"'})
+    assert stale.status_code == 200
+
+
+# /api/qualities/batch
+
+@pytest.fixture
+def lookups(monkeypatch, video_info):
+    """Serve VIDEO_ID, fail 'unavailabl1' and return no formats for 'noformats01'; record each extraction"""
+    calls = []
+
+    def fake_get_video_info(url):
+        calls.append(url)
+        if url.endswith('unavailabl1'):
+            raise Exception('Video unavailable. This video has been removed by the uploader')
+        if url.endswith('noformats01'):
+            return {'title': 'Live soon', 'formats': []}
+        return video_info
+
+    monkeypatch.setattr(app_module, 'get_video_info', fake_get_video_info)
+    return calls
+
+
+def batch(client, urls):
+    return client.post('/api/qualities/batch', json={'urls': urls})
+
+
+def test_batch_reports_each_url_separately(client, lookups):
+    urls = [f'https://youtu.be/{VIDEO_ID}', 'https://youtu.be/unavailabl1', 'https://youtu.be/noformats01',
+            'https://vimeo.com/123']
+    response = batch(client, urls)
+    assert response.status_code == 200
+    results = response.get_json()['results']
+
+    assert [result['url'] for result in results] == urls
+    assert [result['ok'] for result in results] == [True, False, False, False]
+    assert [result.get('status') for result in results] == [None, 404, 422, 400]
+    assert results[0]['data'] == client.post('/api/qualities', json={'url': urls[0]}).get_json()
+    assert results[3]['error'] == 'Only YouTube URLs are supported'
+
+
+def test_batch_looks_up_repeated_urls_once(client, lookups):
+    urls = [f'https://youtu.be/{VIDEO_ID}', 'https://youtu.be/unavailabl1', f'https://youtu.be/{VIDEO_ID}']
+    results = batch(client, urls).get_json()['results']
+
+    assert [(result['url'], result['ok']) for result in results] == [(urls[0], True), (urls[1], False), (urls[0], True)]
+    assert results[0] == results[2]
+    assert len(lookups) == 2
+    # Two distinct URLs cost two tokens
+    assert app_module.take_rate_limit_token('127.0.0.1', cost=app_module.RATE_LIMIT_BURST - 2) == 0
+    assert app_module.take_rate_limit_token('127.0.0.1') > 0
+
+
+def test_batch_is_refused_when_the_bucket_cannot_cover_every_url(client, lookups):
+    assert app_module.take_rate_limit_token('127.0.0.1', cost=app_module.RATE_LIMIT_BURST - 1) == 0
+    response = batch(client, [f'https://youtu.be/{VIDEO_ID}', 'https://youtu.be/unavailabl1'])
+    assert response.status_code == 429
+    assert 'Retry-After' in response.headers
+    assert lookups == []
+    # Nothing was taken, so a single lookup still fits
+    assert batch(client, [f'https://youtu.be/{VIDEO_ID}']).status_code == 200
+
+
+@pytest.mark.parametrize('urls', [
+    [f'https://youtu.be/{i:011d}' for i in range(app_module.BATCH_MAX_URLS + 1)],
+    [],
+    'https://youtu.be/jNQXAC9IVRw',
+    [f'https://youtu.be/{VIDEO_ID}', 42],
+])
+def test_batch_rejects_bad_url_lists(client, lookups, urls):
+    response = batch(client, urls)
+    assert response.status_code == 400
+    assert lookups == []
+
+
+def test_batch_body_is_valid_json_built_from_cached_responses(client, lookups):
+    client.post('/api/qualities', json={'url': f'https://youtu.be/{VIDEO_ID}'})
+    response = batch(client, [f'https://youtu.be/{VIDEO_ID}'])
+    assert response.mimetype == 'application/json'
+    assert orjson.loads(response.get_data())['results'][0]['data']['title'] == 'Me at the zoo'
+    assert len(lookups) == 1
@@ -0,0 +1,46 @@
+"""Tests for the per-client token bucket in front of the YouTube-backed endpoints"""
+import pytest
+
+import app as app_module
+
+VIDEO_URL = 'https://www.youtube.com/watch?v=jNQXAC9IVRw'
+
+
+def test_rate_limit_bucket_allows_burst_then_refills(clock):
+    for _ in range(app_module.RATE_LIMIT_BURST):
+        assert app_module.take_rate_limit_token('1.2.3.4') == 0
+    retry_after = app_module.take_rate_limit_token('1.2.3.4')
+    assert retry_after == pytest.approx(60 / app_module.RATE_LIMIT_PER_MINUTE)
+    # Other clients have their own bucket
+    assert app_module.take_rate_limit_token('5.6.7.8') == 0
+
+    clock.advance(retry_after)
+    assert app_module.take_rate_limit_token('1.2.3.4') == 0
+    assert app_module.take_rate_limit_token('1.2.3.4') > 0
+
+
+def test_rate_limit_cost_is_all_or_nothing(clock):
+    assert app_module.take_rate_limit_token('1.2.3.4', cost=app_module.RATE_LIMIT_BURST - 2) == 0
+    # Three tokens can't be covered by the two left, and none are taken
+    assert app_module.take_rate_limit_token('1.2.3.4', cost=3) == pytest.approx(60 / app_module.RATE_LIMIT_PER_MINUTE)
+    assert app_module.take_rate_limit_token('1.2.3.4', cost=2) == 0
+
+
+def test_endpoint_returns_429_once_the_bucket_is_empty(client, monkeypatch):
+    def private_video(url):
+        raise Exception('This video is private.')
+    monkeypatch.setattr(app_module, 'get_video_info', private_video)
+    statuses = [client.post('/api/qualities', json={'url': VIDEO_URL}).status_code
+                for _ in range(app_module.RATE_LIMIT_BURST + 1)]
+    assert statuses[:-1] == [403] * app_module.RATE_LIMIT_BURST
+    assert statuses[-1] == 429
+
+
+def test_cors_preflights_are_free(client):
+    preflight = {'Origin': 'https://frontend.example', 'Access-Control-Request-Method': 'POST',
+                 'Access-Control-Request-Headers': 'content-type'}
+    for _ in range(app_module.RATE_LIMIT_BURST + 2):
+        response = client.options('/api/qualities', headers=preflight)
+        assert response.status_code == 200
+        assert 'Access-Control-Allow-Origin' in response.headers
+    assert app_module.take_rate_limit_token('127.0.0.1', cost=app_module.RATE_LIMIT_BURST) == 0
@@ -0,0 +1,56 @@
+"""Tests for ffmpeg-remuxed downloads (/api/download), with a stand-in ffmpeg script"""
+import os
+import stat
+
+import pytest
+
+import app as app_module
+
+VIDEO_URL = 'https://www.youtube.com/watch?v=jNQXAC9IVRw'
+
+
+def fake_ffmpeg(tmp_path, script):
+    path = tmp_path / 'ffmpeg'
+    path.write_text('#!/bin/sh\n' + script)
+    path.chmod(path.stat().st_mode | stat.S_IXUSR)
+    return str(path)
+
+
+@pytest.fixture
+def hls_video(monkeypatch, video_info):
+    video_info['formats'].append({'format_id': '96', 'vcodec': 'avc1', 'acodec': 'mp4a', 'ext': 'mp4', 'height': 1080,
+                                  'url': 'https://manifest.example/96.m3u8', 'protocol': 'm3u8_native'})
+    monkeypatch.setattr(app_module, 'get_video_info', lambda url: video_info)
+    staged = []
+
+    def fake_download_to_dir(video_info, format_id, temp_dir, progress_hook=None):
+        staged.append(format_id)
+        path = os.path.join(temp_dir, 'staged.mp4')
+        with open(path, 'wb') as f:
+            f.write(b'staged bytes')
+        return path
+
+    monkeypatch.setattr(app_module, 'download_to_dir', fake_download_to_dir)
+    return staged
+
+
+def download(client):
+    return client.post('/api/download', json={'url': VIDEO_URL, 'format_id': '96'})
+
+
+def test_remuxed_output_is_streamed(client, monkeypatch, tmp_path, hls_video):
+    monkeypatch.setattr(app_module, 'FFMPEG_PATH', fake_ffmpeg(tmp_path, "printf 'remuxed bytes'\n"))
+    with download(client) as response:
+        assert response.status_code == 200
+        assert response.get_data() == b'remuxed bytes'
+    assert hls_video == []
+
+
+def test_ffmpeg_failing_without_output_falls_back_to_staged_download(client, monkeypatch, tmp_path, hls_video, capsys):
+    script = "echo 'manifest.example/96.m3u8: Invalid data found when processing input' >&2\nexit 1\n"
+    monkeypatch.setattr(app_module, 'FFMPEG_PATH', fake_ffmpeg(tmp_path, script))
+    with download(client) as response:
+        assert response.status_code == 200
+        assert response.get_data() == b'staged bytes'
+    assert hls_video == ['96']
+    assert 'ffmpeg exited with status 1: manifest.example/96.m3u8: Invalid data found' in capsys.readouterr().out
@@ -0,0 +1,50 @@
+"""Tests for YouTube URL validation"""
+import pytest
+
+import app as app_module
+
+VIDEO_ID = 'jNQXAC9IVRw'
+
+
+@pytest.mark.parametrize('url', [
+    f'https://www.youtube.com/watch?v={VIDEO_ID}',
+    f'http://youtube.com/watch?v={VIDEO_ID}&t=5s',
+    f'https://m.youtube.com/watch?feature=share&v={VIDEO_ID}',
+    f'https://music.youtube.com/watch?v={VIDEO_ID}&list=PL1234567890',
+    f'https://youtu.be/{VIDEO_ID}?si=abc',
+    f'https://www.youtube.com/shorts/{VIDEO_ID}',
+    f'https://www.youtube.com/embed/{VIDEO_ID}',
+    f'https://www.youtube.com/live/{VIDEO_ID}',
+    f'HTTPS://WWW.YOUTUBE.COM/watch?v={VIDEO_ID}',
+])
+def test_video_urls_are_canonicalized(url):
+    assert app_module.canonical_youtube_url(url) == f'https://www.youtube.com/watch?v={VIDEO_ID}'
+
+
+@pytest.mark.parametrize('url', [
+    'https://www.youtube.com/playlist?list=PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs',
+    'https://www.youtube.com/watch?list=PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs',
+    'https://www.youtube.com/@channel/videos',
+    f'https://www.youtube.com/watch?v={VIDEO_ID}x',
+    'https://www.youtube.com/watch?v=short',
+    f'https://evil.example/watch?v={VIDEO_ID}',
+    f'https://youtube.com.evil.example/watch?v={VIDEO_ID}',
+    f'https://vimeo.com/{VIDEO_ID}',
+    'https://youtu.be/ééééééééééé',
+    'https://www.youtube.com/watch?v=日本語のビデオタイトルです',
+    f'https://youtu.be/{VIDEO_ID}é',
+])
+def test_non_video_urls_are_rejected(url):
+    assert app_module.YOUTUBE_URL_RE.match(url) is None
+    assert app_module.canonical_youtube_url(url) is None
+
+
+def test_require_youtube_url_rejects_non_http_and_playlists():
+    with pytest.raises(Exception, match='must start with http'):
+        app_module.require_youtube_url(f'ftp://youtube.com/watch?v={VIDEO_ID}')
+    with pytest.raises(Exception, match='Only YouTube URLs'):
+        app_module.require_youtube_url('https://www.youtube.com/playlist?list=PL590L5WQmH8fJ54F369BLDSqIwcs-TCfs')
+
+
+def test_cache_key_is_the_video_id():
+    assert app_module.video_cache_key(f'https://www.youtube.com/watch?v={VIDEO_ID}') == VIDEO_ID